@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import threading
+import time
+from gimbal import Gimbal
+
+
+class ControlLoop(object):
+    """
+    Fixed rate actuator loop for a Picarx
+
+    Any thread latches the desired state with set(), the loop thread wakes
+    up at a fixed rate and sends only what changed since the previous tick
+    to the car, in one I2C batch. However fast commands arrive, the bus
+    sees at most one update per tick. Pan and tilt go through a Gimbal,
+    so the camera follows the latest target at a limited speed and is only
+    written when the servo pulse actually changes. A tick that raises
+    stops the car and the loop carries on.
+
+    Usage::
+
+        loop = ControlLoop(px, rate=100)
+        loop.start()
+        loop.set(speed=30, steering=-15)
+        loop.set(pan=20, tilt=10)
+    """
+    STATE = ("speed", "steering", "pan", "tilt")
+    """Latched values: speed(-100~100, negative is backward), steering, pan and tilt angles"""
+
+    def __init__(self, px, rate=100, gimbal=None):
+        """
+        Initialize the control loop
+
+        :param px: car to drive
+        :type px: picarx.Picarx
+        :param rate: ticks per second
+        :type rate: int/float
+        :param gimbal: camera input shaping, default to a Gimbal limited to the car's pan/tilt range
+        :type gimbal: Gimbal
+        """
+        self.px = px
+        if gimbal is None:
+            gimbal = Gimbal(pan_limits=(px.CAM_PAN_MIN, px.CAM_PAN_MAX),
+                            tilt_limits=(px.CAM_TILT_MIN, px.CAM_TILT_MAX))
+        self.gimbal = gimbal
+        self.period = 1.0 / rate
+        self._lock = threading.Lock()
+        self._desired = dict.fromkeys(self.STATE, 0)
+        self._applied = dict.fromkeys(self.STATE, None)
+        self._running = False
+        self._thread = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._ticks = 0
+        self._late = 0
+        self._jitter_sum = 0.0
+        self._jitter_max = 0.0
+        self._tick_time_max = 0.0
+        self._errors = 0
+        self._failing = False
+
+    def set(self, **state):
+        """
+        Latch new desired values, applied on the next tick
+
+        :param state: any of speed, steering, pan, tilt
+        :raise ValueError: on an unknown key
+        """
+        for key in state:
+            if key not in self._desired:
+                raise ValueError(f'Unknown control "{key}", must be one of {self.STATE}')
+        with self._lock:
+            self._desired.update(state)
+
+    def get(self):
+        """
+        Get the latched desired state
+
+        :return: {"speed", "steering", "pan", "tilt"}
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._desired)
+
+    def halt(self):
+        """Latch speed 0 and stop the motors right away, without waiting for the next tick"""
+        with self._lock:
+            self._desired["speed"] = 0
+            self._applied["speed"] = 0
+            self.px.stop()
+
+    def start(self):
+        """Start the loop thread"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="control-loop")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the loop thread and the motors"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.halt()
+
+    def stats(self):
+        """
+        Get timing statistics
+
+        :return: ticks, late ticks (more than one period behind), mean and max
+            wake-up jitter (s), longest tick (s), failed ticks
+        :rtype: dict
+        """
+        ticks = max(self._ticks, 1)
+        return {
+            "ticks": self._ticks,
+            "late": self._late,
+            "jitter_mean": self._jitter_sum / ticks,
+            "jitter_max": self._jitter_max,
+            "tick_time_max": self._tick_time_max,
+            "errors": self._errors,
+        }
+
+    def _run(self):
+        next_tick = time.monotonic()
+        last = next_tick - self.period
+        while self._running:
+            now = time.monotonic()
+            jitter = now - next_tick
+            self._ticks += 1
+            self._jitter_sum += jitter
+            self._jitter_max = max(self._jitter_max, jitter)
+
+            try:
+                self.tick(now - last)
+                self._failing = False
+            except Exception as e:
+                # a failed write must not end the loop and leave the motors running
+                self._errors += 1
+                if not self._failing:
+                    print(f"Control tick failed, stopping the car: {e}")
+                self._failing = True
+                try:
+                    self.halt()
+                except Exception as e:
+                    print(f"Stopping the car failed: {e}")
+            last = now
+            self._tick_time_max = max(self._tick_time_max, time.monotonic() - now)
+
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay < -self.period:
+                # fell behind, skip the missed ticks instead of bursting
+                self._late += 1
+                next_tick = time.monotonic() + self.period
+                delay = self.period
+            if delay > 0:
+                time.sleep(delay)
+
+    def _changed(self, key, value):
+        applied = self._applied[key]
+        if applied is None:
+            return True
+        if key in ("pan", "tilt"):
+            return self._pulse(key, value) != self._pulse(key, applied)
+        return value != applied
+
+    def _pulse(self, key, angle):
+        # PWM value set_cam_pan_angle()/set_cam_tilt_angle() write, calibration offset and negation included
+        calibration = self.px.cam_pan_cali_val if key == "pan" else self.px.cam_tilt_cali_val
+        return Gimbal.pulse(-1 * (angle - calibration))
+
+    def tick(self, dt=None):
+        """
+        Apply the changes latched since the last tick, called by the loop thread
+
+        :param dt: time since the previous tick, default to the loop period
+        :type dt: float
+        """
+        if dt is None:
+            dt = self.period
+        with self._lock:
+            desired = dict(self._desired)
+            desired["pan"], desired["tilt"] = self.gimbal.step(desired["pan"], desired["tilt"], dt)
+            changed = [key for key in self.STATE if self._changed(key, desired[key])]
+            if not changed:
+                return
+            speed = desired["speed"]
+            with self.px.batch():
+                if "steering" in changed:
+                    self.px.set_dir_servo_angle(desired["steering"])
+                # forward()/backward() scale the wheels by the steering angle
+                if "speed" in changed or "steering" in changed:
+                    if speed > 0:
+                        self.px.forward(speed)
+                    elif speed < 0:
+                        self.px.backward(-speed)
+                if "pan" in changed:
+                    self.px.set_cam_pan_angle(desired["pan"])
+                if "tilt" in changed:
+                    self.px.set_cam_tilt_angle(desired["tilt"])
+            if "speed" in changed and speed == 0:
+                self.px.stop()
+            for key in changed:
+                self._applied[key] = desired[key]
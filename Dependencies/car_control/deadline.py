@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import heapq
+import itertools
+import threading
+import time
+
+
+class DeadlineScheduler(object):
+    """
+    Named, resettable deadlines served by a single thread
+
+    Arming a name again pushes its deadline back, so a deadman switch is
+    just "arm on every refresh". However many deadlines are armed or
+    re-armed, only one thread ever waits on them.
+
+    Usage::
+
+        deadlines = DeadlineScheduler()
+        # stop unless forward is refreshed within 3 s
+        deadlines.arm("forward", 3.0, stop_forward)
+        deadlines.cancel("forward")
+    """
+
+    def __init__(self):
+        """Initialize and start the scheduler thread"""
+        self._heap = []
+        self._armed = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="deadlines")
+        self._thread.start()
+
+    def arm(self, name, timeout, callback):
+        """
+        Arm or re-arm a deadline
+
+        :param name: deadline name, replaces any deadline armed with the same name
+        :type name: str
+        :param timeout: seconds from now
+        :type timeout: float
+        :param callback: called with no argument from the scheduler thread when the deadline passes
+        :type callback: callable
+        """
+        with self._cond:
+            token = next(self._counter)
+            self._armed[name] = token
+            heapq.heappush(self._heap, (time.monotonic() + timeout, token, name, callback))
+            # superseded entries stay in the heap until they reach the top, drop them if they pile up
+            if len(self._heap) > 2 * len(self._armed) + 64:
+                self._heap = [entry for entry in self._heap if self._armed.get(entry[2]) == entry[1]]
+                heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def cancel(self, name):
+        """
+        Disarm a deadline
+
+        :param name: deadline name
+        :type name: str
+        :return: True if the deadline was armed
+        :rtype: bool
+        """
+        with self._cond:
+            return self._armed.pop(name, None) is not None
+
+    def is_armed(self, name):
+        """
+        Check if a deadline is armed
+
+        :param name: deadline name
+        :type name: str
+        :rtype: bool
+        """
+        with self._cond:
+            return name in self._armed
+
+    def _next_due(self):
+        # pop and return the callback of the first live deadline that passed,
+        # or return how long to wait for it
+        while self._heap:
+            when, token, name, callback = self._heap[0]
+            if self._armed.get(name) != token:
+                heapq.heappop(self._heap)
+                continue
+            delay = when - time.monotonic()
+            if delay > 0:
+                return None, delay
+            heapq.heappop(self._heap)
+            del self._armed[name]
+            return callback, 0
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                callback, delay = self._next_due()
+                while callback is None:
+                    self._cond.wait(delay)
+                    callback, delay = self._next_due()
+            try:
+                callback()
+            except Exception as e:
+                print(f"Deadline callback failed: {e}")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+
+class Gimbal(object):
+    """
+    Camera pan/tilt input shaping
+
+    Mouse input arrives far faster and noisier than the servos can follow.
+    step() moves the commanded angles toward the latest target, clamped to
+    what the servos can reach, ignoring changes smaller than the deadband
+    and limiting the speed to max_dps, and pulse() tells whether an angle change is big enough to reach the
+    servo at all.
+    """
+    MAX_DPS = 428
+    """Servo max Degree Per Second, same as robot_hat.Robot.max_dps"""
+    DEADBAND = 1.0
+    """Target changes smaller than this (degrees) are ignored"""
+    PAN_LIMITS = (-90, 90)
+    """Pan range (degrees), same as Picarx.CAM_PAN_MIN, Picarx.CAM_PAN_MAX"""
+    TILT_LIMITS = (-35, 65)
+    """Tilt range (degrees), same as Picarx.CAM_TILT_MIN, Picarx.CAM_TILT_MAX"""
+
+    # robot_hat.Servo pulse range and PWM period
+    MIN_PW = 500
+    MAX_PW = 2500
+    PERIOD = 4095
+
+    def __init__(self, max_dps=MAX_DPS, deadband=DEADBAND, pan_limits=PAN_LIMITS, tilt_limits=TILT_LIMITS):
+        """
+        Initialize the gimbal
+
+        :param max_dps: max speed, degrees per second
+        :type max_dps: int/float
+        :param deadband: min target change to move, degrees
+        :type deadband: int/float
+        :param pan_limits: min, max pan angle
+        :type pan_limits: tuple
+        :param tilt_limits: min, max tilt angle
+        :type tilt_limits: tuple
+        """
+        self.max_dps = max_dps
+        self.deadband = deadband
+        self.pan_limits = pan_limits
+        self.tilt_limits = tilt_limits
+        self.pan = 0.0
+        self.tilt = 0.0
+
+    def _axis(self, current, target, limits, max_step):
+        # never slew through angles the servo can't reach, it would only delay the next reversal
+        target = max(limits[0], min(limits[1], target))
+        delta = target - current
+        if abs(delta) < self.deadband:
+            return current
+        return current + max(-max_step, min(max_step, delta))
+
+    def step(self, pan, tilt, dt):
+        """
+        Move toward the target angles for one control tick
+
+        :param pan: target pan angle
+        :type pan: float
+        :param tilt: target tilt angle
+        :type tilt: float
+        :param dt: time since the previous step, seconds
+        :type dt: float
+        :return: pan, tilt angles to command
+        :rtype: tuple
+        """
+        max_step = self.max_dps * dt
+        self.pan = self._axis(self.pan, pan, self.pan_limits, max_step)
+        self.tilt = self._axis(self.tilt, tilt, self.tilt_limits, max_step)
+        return self.pan, self.tilt
+
+    @classmethod
+    def pulse(cls, angle):
+        """
+        Quantize an angle to the PWM value robot_hat.Servo.angle() would write
+
+        :param angle: angle(-90~90)
+        :type angle: float
+        :return: PWM pulse width value
+        :rtype: int
+        """
+        angle = max(-90, min(90, angle))
+        pulse_width_time = (angle + 90) * (cls.MAX_PW - cls.MIN_PW) / 180 + cls.MIN_PW
+        return int(pulse_width_time / 20000 * cls.PERIOD)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import threading
+import protocol
+
+FORWARD = 1 << protocol.KEYS.index("forward")
+BACKWARD = 1 << protocol.KEYS.index("backward")
+RIGHT = 1 << protocol.KEYS.index("right")
+LEFT = 1 << protocol.KEYS.index("left")
+
+
+def build_actions(turn_angle=30, idle_steering=None):
+    """
+    Precompute the action of every key combination
+
+    Rules, first match wins:
+
+    ==========================  =========  ===========
+    keys                        direction  steering
+    ==========================  =========  ===========
+    forward, no turn            1          0
+    backward, no turn           -1         0
+    right, no forward/backward  None       turn_angle
+    left, no forward/backward   None       -turn_angle
+    forward + right/left        1          +/-turn_angle
+    backward + right/left       -1         +/-turn_angle
+    anything else               0          idle_steering
+    ==========================  =========  ===========
+
+    :param turn_angle: steering angle while turning
+    :type turn_angle: int/float
+    :param idle_steering: steering when no rule matches, None to leave it
+    :type idle_steering: int/float
+    :return: (direction, steering) for each of the 16 masks, direction is
+        1 forward, -1 backward, 0 stop, None leaves a value unchanged
+    :rtype: tuple
+    """
+    actions = []
+    for mask in range(16):
+        forward = bool(mask & FORWARD)
+        backward = bool(mask & BACKWARD)
+        right = bool(mask & RIGHT)
+        left = bool(mask & LEFT)
+        turning = right or left
+        moving = forward or backward
+        angle = turn_angle if right else -turn_angle
+        if forward and not turning:
+            action = (1, 0)
+        elif backward and not turning:
+            action = (-1, 0)
+        elif turning and not moving:
+            action = (None, angle)
+        elif forward:
+            action = (1, angle)
+        elif backward:
+            action = (-1, angle)
+        else:
+            action = (0, idle_steering)
+        actions.append(action)
+    return tuple(actions)
+
+
+ACTIONS = build_actions()
+"""Default action table, as driven from the keyboard"""
+
+
+class KeyState(object):
+    """
+    Pressed keys as a bitmask, mapped to driving actions by table lookup
+
+    Usage::
+
+        keys = KeyState()
+        keys.update(protocol.parse("forward:1"))
+        direction, steering = keys.action()
+    """
+
+    def __init__(self, actions=ACTIONS):
+        """
+        Initialize with no key pressed
+
+        :param actions: action table from build_actions()
+        :type actions: tuple
+        """
+        self.actions = actions
+        self.mask = 0
+        self._lock = threading.Lock()
+
+    def press(self, key):
+        """
+        Mark a key as pressed
+
+        :param key: one of protocol.KEYS
+        :type key: str
+        :return: True if the key was not pressed before
+        :rtype: bool
+        """
+        bit = 1 << protocol.KEYS.index(key)
+        with self._lock:
+            was_pressed = self.mask & bit
+            self.mask |= bit
+        return not was_pressed
+
+    def release(self, key):
+        """
+        Mark a key as released
+
+        :param key: one of protocol.KEYS
+        :type key: str
+        :return: True if the key was pressed before
+        :rtype: bool
+        """
+        bit = 1 << protocol.KEYS.index(key)
+        with self._lock:
+            was_pressed = self.mask & bit
+            self.mask &= ~bit
+        return bool(was_pressed)
+
+    def release_all(self):
+        """Mark every key as released"""
+        with self._lock:
+            self.mask = 0
+
+    def update(self, cmd):
+        """
+        Apply an OP_KEY command, other commands are ignored
+
+        :param cmd: decoded command
+        :type cmd: protocol.Command
+        :return: True if the key state changed
+        :rtype: bool
+        """
+        if cmd.op != protocol.OP_KEY:
+            return False
+        key = protocol.key_name(cmd)
+        if protocol.is_pressed(cmd):
+            return self.press(key)
+        return self.release(key)
+
+    def is_pressed(self, key):
+        """
+        Check if a key is pressed
+
+        :param key: one of protocol.KEYS
+        :type key: str
+        :rtype: bool
+        """
+        return bool(self.mask & (1 << protocol.KEYS.index(key)))
+
+    def action(self):
+        """
+        Get the action for the keys currently pressed
+
+        :return: direction (1, -1, 0 or None) and steering angle (or None)
+        :rtype: tuple
+        """
+        return self.actions[self.mask]
+
+    def __repr__(self):
+        pressed = [key for key in protocol.KEYS if self.is_pressed(key)]
+        return f"KeyState({pressed})"
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Car control WebSocket protocol
+
+Binary frames are a fixed 12 byte little endian struct::
+
+    uint8  opcode   OP_KEY, OP_MOUSE or OP_PING
+    uint8  flags    FLAG_PRESSED, FLAG_ECHO
+    int16  axes[4]  OP_KEY: key index in KEYS, 0, 0, 0
+                    OP_MOUSE: x, y, page width, page height
+                    OP_PING: unused, keeps the connection failsafe armed
+    uint16 seq      sender's sequence number, wraps around
+
+The old colon delimited text commands ("forward:1", "mm:312 200 1280 720",
+"sent:hello", "ping") are still accepted. Free text (OP_TEXT) is only sent as text.
+"""
+import struct
+from collections import namedtuple
+
+FRAME = struct.Struct("<BB4hH")
+
+OP_KEY = 1
+OP_MOUSE = 2
+OP_TEXT = 3
+OP_PING = 4
+
+FLAG_PRESSED = 0x01
+"""OP_KEY: key went down, cleared when it went up"""
+FLAG_ECHO = 0x02
+"""Ask the server to send the message back"""
+
+KEYS = ("forward", "backward", "right", "left")
+"""Key names, indexed by the key axis of OP_KEY frames"""
+
+_OPS = {"mm": OP_MOUSE, "sent": OP_TEXT, "ping": OP_PING}
+_BINARY_OPS = (OP_KEY, OP_MOUSE, OP_PING)
+
+Command = namedtuple("Command", "op flags axes seq text")
+"""A decoded message, text is only set for OP_TEXT"""
+
+
+def encode(op, flags=0, axes=(0, 0, 0, 0), seq=0):
+    """
+    Build a binary frame
+
+    :param op: OP_KEY, OP_MOUSE or OP_PING
+    :type op: int
+    :param flags: FLAG_* bits
+    :type flags: int
+    :param axes: 4 int16 values
+    :type axes: tuple
+    :param seq: sequence number
+    :type seq: int
+    :return: frame
+    :rtype: bytes
+    """
+    return FRAME.pack(op, flags, *axes, seq & 0xFFFF)
+
+
+def encode_key(key, pressed, seq=0):
+    """
+    Build an OP_KEY frame
+
+    :param key: one of KEYS
+    :type key: str
+    :param pressed: True for key down
+    :type pressed: bool
+    :return: frame
+    :rtype: bytes
+    """
+    return encode(OP_KEY, FLAG_PRESSED if pressed else 0, (KEYS.index(key), 0, 0, 0), seq)
+
+
+def parse(message):
+    """
+    Decode a binary frame or a legacy text command
+
+    :param message: message received from the WebSocket
+    :type message: bytes/str
+    :return: decoded command, None if malformed, of an unknown opcode
+        or a mouse move without a page size
+    :rtype: Command
+    """
+    if isinstance(message, (bytes, bytearray)):
+        if len(message) != FRAME.size:
+            return None
+        op, flags, a0, a1, a2, a3, seq = FRAME.unpack(message)
+        if op not in _BINARY_OPS:
+            return None
+        if op == OP_KEY and not 0 <= a0 < len(KEYS):
+            return None
+        if op == OP_MOUSE and not _valid_page(a2, a3):
+            return None
+        return Command(op, flags, (a0, a1, a2, a3), seq, None)
+
+    name, _, value = message.strip().partition(":")
+    if name in KEYS:
+        flags = FLAG_PRESSED if value == "1" else 0
+        return Command(OP_KEY, flags, (KEYS.index(name), 0, 0, 0), 0, None)
+    op = _OPS.get(name)
+    if op == OP_TEXT:
+        return Command(OP_TEXT, 0, (0, 0, 0, 0), 0, value)
+    if op == OP_PING:
+        return Command(OP_PING, 0, (0, 0, 0, 0), 0, None)
+    if op == OP_MOUSE:
+        try:
+            axes = tuple(int(i) for i in value.split(" "))
+        except ValueError:
+            return None
+        if len(axes) != 4 or not _valid_page(axes[2], axes[3]):
+            return None
+        return Command(OP_MOUSE, 0, axes, 0, None)
+    return None
+
+
+def _valid_page(width, height):
+    # mouse positions are scaled by the page size
+    return width > 0 and height > 0
+
+
+def key_name(cmd):
+    """
+    Get the key of an OP_KEY command
+
+    :param cmd: decoded command
+    :type cmd: Command
+    :return: one of KEYS
+    :rtype: str
+    """
+    return KEYS[cmd.axes[0]]
+
+
+def is_pressed(cmd):
+    """
+    Check if an OP_KEY command is a key down
+
+    :param cmd: decoded command
+    :type cmd: Command
+    :rtype: bool
+    """
+    return bool(cmd.flags & FLAG_PRESSED)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+import threading
+import urllib.request
+
+RECORD_URL = "http://127.0.0.1:8000/record"
+"""Recording endpoint of camera_stream_server.py started with --record"""
+
+RECORD_COMMANDS = {"record": "start", "stop recording": "stop"}
+"""Text commands, typed or spoken, and the /record action they map to"""
+
+
+def request_recording(action, url=RECORD_URL, timeout=2.0):
+    """
+    Ask the camera server to start or stop recording, without waiting for it
+
+    :param action: "start", "stop" or "trigger"
+    :type action: str
+    :param url: recording endpoint
+    :type url: str
+    :param timeout: seconds before giving up on the camera server
+    :type timeout: float
+    """
+    def send():
+        try:
+            with urllib.request.urlopen(f"{url}?action={action}", timeout=timeout) as response:
+                print(f"Recording {action}: {response.read().decode()}")
+        except OSError as e:
+            print(f"Recording {action} failed: {e}")
+    threading.Thread(target=send, daemon=True).start()
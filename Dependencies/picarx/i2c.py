@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 from .basic import _Basic_class
-from .utils import run_command
+from .i2c_bus import I2CBus, scan_bus
 from smbus2 import SMBus
+from concurrent.futures import Future
+from contextlib import contextmanager
 import multiprocessing
+import threading
 
 
 def _retry_wrapper(func):
 
     def wrapper(self, *arg, **kwargs):
-        for _ in range(self.RETRY):
+        # the bus thread already retries every request, don't multiply its attempts
+        attempts = 1 if isinstance(self._smbus, I2CBus) else self.RETRY
+        for _ in range(attempts):
             try:
                 return func(self, *arg, **kwargs)
             except OSError:
@@ -26,8 +31,24 @@ class I2C(_Basic_class):
     """
     RETRY = 5
 
+    BUS_THREAD = True
+    """Run transactions on the shared I2CBus thread instead of a private SMBus"""
+
+    BLOCK_MAX = 32
+    """Max data bytes in one SMBus block write"""
+
+    BLOCK_RUNS = False
+    """Flush adjacent batched registers as one block write, only for devices known to auto-increment across them"""
+
     # i2c_lock = multiprocessing.Value('i', 0)
 
+    # per-thread write batch, see I2C.batch()
+    _batch = threading.local()
+
+    # scan results per bus number, see I2C.scan()
+    _scan_cache = {}
+    _scan_lock = threading.Lock()
+
     def __init__(self, address=None, bus=1, *args, **kwargs):
         """
         Initialize the I2C bus
@@ -39,7 +60,10 @@ class I2C(_Basic_class):
         """
         super().__init__(*args, **kwargs)
         self._bus = bus
-        self._smbus = SMBus(self._bus)
+        if self.BUS_THREAD:
+            self._smbus = I2CBus.get(self._bus)
+        else:
+            self._smbus = SMBus(self._bus)
         if isinstance(address, list):
             connected_devices = self.scan()
             for _addr in address:
@@ -113,7 +137,7 @@ class I2C(_Basic_class):
 
     @_retry_wrapper
     def is_ready(self):
-        """Check if the I2C device is ready
+        """Check if the I2C device is ready, from the cached scan()
 
         :return: True if the I2C device is ready, False otherwise
         :rtype: bool
@@ -124,38 +148,151 @@ class I2C(_Basic_class):
         else:
             return False
 
-    def scan(self):
+    def scan(self, refresh=False):
         """Scan the I2C bus for devices
 
+        The bus is probed once per process, later calls return the cached
+        result until refresh is set or invalidate_scan() is called.
+
+        :param refresh: probe the bus again even if cached
+        :type refresh: bool
         :return: List of I2C addresses of devices found
         :rtype: list
         """
-        cmd = f"i2cdetect -y {self._bus}"
-        # Run the i2cdetect command
-        _, output = run_command(cmd)
-
-        # Parse the output
-        outputs = output.split('\n')[1:]
-        addresses = []
-        addresses_str = []
-        for tmp_addresses in outputs:
-            if tmp_addresses == "":
-                continue
-            tmp_addresses = tmp_addresses.split(':')[1]
-            # Split the addresses into a list
-            tmp_addresses = tmp_addresses.strip().split(' ')
-            for address in tmp_addresses:
-                if address != '--':
-                    addresses.append(int(address, 16))
-                    addresses_str.append(f'0x{address}')
-        self._debug(f"Conneceted i2c device: {addresses_str}")
-        return addresses
+        with I2C._scan_lock:
+            if refresh or self._bus not in I2C._scan_cache:
+                if isinstance(self._smbus, I2CBus):
+                    addresses = self._smbus.scan()
+                else:
+                    addresses = scan_bus(self._smbus)
+                I2C._scan_cache[self._bus] = addresses
+                self._debug(f"Conneceted i2c device: {[f'0x{i:02X}' for i in addresses]}")
+            return list(I2C._scan_cache[self._bus])
+
+    @classmethod
+    def invalidate_scan(cls, bus=None):
+        """Drop cached scan results, the next scan() probes the bus again
+
+        :param bus: I2C bus number, None for all buses
+        :type bus: int
+        """
+        with cls._scan_lock:
+            if bus is None:
+                cls._scan_cache.clear()
+            else:
+                cls._scan_cache.pop(bus, None)
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """Batch register writes until the block exits
+
+        Word writes queued by :meth:`_queue_word` inside the block are
+        coalesced per register (last value wins) and written when the
+        outermost block exits, one write per register. On devices with
+        BLOCK_RUNS set, adjacent registers are flushed together as one
+        write_i2c_block_data instead. Blocks may be nested, only the
+        outermost one flushes.
+
+        Usage::
+
+            with I2C.batch():
+                pan.angle(10)
+                tilt.angle(20)
+        """
+        batch = cls._batch
+        if getattr(batch, "depth", 0) == 0:
+            batch.depth = 0
+            batch.pending = {}
+        batch.depth += 1
+        try:
+            yield
+        finally:
+            batch.depth -= 1
+            if batch.depth == 0:
+                pending = batch.pending
+                batch.pending = {}
+                cls._flush(pending)
+
+    @classmethod
+    def is_batching(cls):
+        """Check if the calling thread is inside an I2C.batch() block
+
+        :return: True if writes are being batched, False otherwise
+        :rtype: bool
+        """
+        return getattr(cls._batch, "depth", 0) > 0
+
+    def _queue_word(self, reg, data):
+        """Queue a 2 bytes register write if batching
+
+        :param reg: register address
+        :type reg: int
+        :param data: 2 bytes to write, high byte first
+        :type data: list
+        :return: True if queued, False if the caller should write now
+        :rtype: bool
+        """
+        if not self.is_batching():
+            return False
+        device = (self._bus, self.address)
+        regs = self._batch.pending.setdefault(device, (self, {}))[1]
+        regs[reg] = list(data)
+        return True
+
+    @classmethod
+    def _flush(cls, pending):
+        """Write out queued registers, one block write per run of adjacent registers if BLOCK_RUNS is set"""
+        for i2c, regs in pending.values():
+            words_per_block = cls.BLOCK_MAX // 2 if i2c.BLOCK_RUNS else 1
+            run = []
+            for reg in sorted(regs):
+                if run and (reg != run[-1] + 1 or len(run) >= words_per_block):
+                    i2c._write_run(run, regs)
+                    run = []
+                run.append(reg)
+            if run:
+                i2c._write_run(run, regs)
+
+    def _write_run(self, run, regs):
+        if len(run) == 1:
+            result = self.write([run[0]] + regs[run[0]])
+        else:
+            data = []
+            for reg in run:
+                data += regs[reg]
+            result = self._write_i2c_block_data(run[0], data)
+        self._check_write(result, {reg: regs[reg] for reg in run})
+
+    def _check_write(self, result, regs):
+        """Call :meth:`_write_failed` if a register write failed, once the bus thread ran it
+
+        :param result: what the write returned, False or a Future on the bus thread
+        :param regs: registers written, {reg: data bytes}
+        :type regs: dict
+        """
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self._write_done(future, regs))
+        elif result is False:
+            self._write_failed(regs)
+
+    def _write_done(self, future, regs):
+        if future.cancelled() or future.exception() is not None or future.result() is False:
+            self._write_failed(regs)
+
+    def _write_failed(self, regs):
+        """Called with the registers of a write that did not happen, {reg: data bytes}
+
+        Subclasses caching register values drop them here.
+        """
+        self._error(f"write to 0x{self.address:02X} failed: {[f'0x{reg:02X}' for reg in regs]}")
 
     def write(self, data):
         """Write data to the I2C device
 
         :param data: Data to write
         :type data: int/list/bytearray
+        :return: False if the write failed after retries
         :raises: ValueError if write is not an int, list or bytearray
         """
         if isinstance(data, bytearray):
@@ -178,19 +315,19 @@ class I2C(_Basic_class):
         # Write data
         if len(data_all) == 1:
             data = data_all[0]
-            self._write_byte(data)
+            return self._write_byte(data)
         elif len(data_all) == 2:
             reg = data_all[0]
             data = data_all[1]
-            self._write_byte_data(reg, data)
+            return self._write_byte_data(reg, data)
         elif len(data_all) == 3:
             reg = data_all[0]
             data = (data_all[2] << 8) + data_all[1]
-            self._write_word_data(reg, data)
+            return self._write_word_data(reg, data)
         else:
             reg = data_all[0]
             data = list(data_all[1:])
-            self._write_i2c_block_data(reg, data)
+            return self._write_i2c_block_data(reg, data)
 
     def read(self, length=1):
         """Read data from I2C device
@@ -250,7 +387,7 @@ class I2C(_Basic_class):
 
     def is_avaliable(self):
         """
-        Check if the I2C device is avaliable
+        Check if the I2C device is avaliable, from the cached scan()
 
         :return: True if the I2C device is avaliable, False otherwise
         :rtype: bool
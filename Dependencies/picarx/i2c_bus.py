@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+from .basic import _Basic_class
+from smbus2 import SMBus
+from concurrent.futures import Future
+from contextlib import contextmanager
+from collections import deque
+import threading
+
+
+def probe(smbus, address):
+    """
+    Check if a device answers at an address, the same way i2cdetect does
+
+    :param smbus: open bus
+    :type smbus: smbus2.SMBus
+    :param address: 7 bit device address
+    :type address: int
+    :return: True if the device acked
+    :rtype: bool
+    """
+    try:
+        # quick write can corrupt EEPROMs and is ignored by some chips, read those instead
+        if 0x30 <= address <= 0x37 or 0x50 <= address <= 0x5F:
+            smbus.read_byte(address)
+        else:
+            smbus.write_quick(address)
+    except OSError:
+        return False
+    return True
+
+
+def scan_bus(smbus, first=0x08, last=0x77):
+    """
+    Probe every address of a bus
+
+    :param smbus: open bus
+    :type smbus: smbus2.SMBus
+    :return: addresses of the devices found
+    :rtype: list
+    """
+    return [address for address in range(first, last + 1) if probe(smbus, address)]
+
+
+class _Request(object):
+    __slots__ = ("method", "args", "key", "priority", "retry", "future", "cancelled")
+
+    def __init__(self, method, args, key, priority, retry):
+        self.method = method
+        self.args = args
+        self.key = key
+        self.priority = priority
+        self.retry = retry
+        self.future = Future()
+        self.cancelled = False
+
+
+class I2CBus(_Basic_class):
+    """
+    I2C bus owner thread
+
+    One I2CBus per bus number owns the SMBus handle and runs every
+    transaction from its own thread, so any number of producer threads
+    can share the bus safely. Requests are served highest priority first,
+    FIFO within a priority. A new write always joins the tail of its
+    queue. Queued writes to the same device whose registers it overlaps
+    are dropped if they have a lower priority, since they would run
+    after it and undo it. A queued write of the same priority is dropped
+    only if the new write covers all of its registers. Registers are
+    SMBus command codes: a byte or word write covers its register, a
+    block write covers one register per data byte.
+
+    The SMBus style methods (write_word_data, read_byte, ...) let an
+    I2CBus stand in for an SMBus object: writes return a Future
+    immediately, reads block until the value is available. Use
+    read_async() to get a Future for a read instead.
+    """
+    URGENT = 0
+    """Priority for emergency commands, e.g. stopping the motors"""
+    NORMAL = 1
+    """Default priority"""
+    LOW = 2
+    """Priority for background polling"""
+
+    RETRY = 5
+
+    _buses = {}
+    _buses_lock = threading.Lock()
+    _local = threading.local()
+
+    @classmethod
+    def get(cls, bus=1, *args, **kwargs):
+        """
+        Get the process wide I2CBus for a bus number, start it if needed
+
+        :param bus: I2C bus number
+        :type bus: int
+        :return: bus service
+        :rtype: I2CBus
+        """
+        with cls._buses_lock:
+            if bus not in cls._buses:
+                cls._buses[bus] = cls(bus, *args, **kwargs)
+            return cls._buses[bus]
+
+    @classmethod
+    @contextmanager
+    def urgent(cls):
+        """
+        Submit every request made by this thread inside the block as URGENT
+
+        Usage::
+
+            with I2CBus.urgent():
+                px.stop()
+        """
+        prev = getattr(cls._local, "priority", cls.NORMAL)
+        cls._local.priority = cls.URGENT
+        try:
+            yield
+        finally:
+            cls._local.priority = prev
+
+    def __init__(self, bus=1, *args, **kwargs):
+        """
+        Initialize the bus service and start its thread
+
+        :param bus: I2C bus number
+        :type bus: int
+        :raise OSError: if the bus can't be opened
+        """
+        super().__init__(*args, **kwargs)
+        self._bus = bus
+        self._queues = [deque(), deque(), deque()]
+        # queued coalescable writes per device address
+        self._pending_writes = {}
+        self._cond = threading.Condition()
+        # opened here so a missing bus raises to the caller, and get() caches nothing
+        smbus = SMBus(bus)
+        self._thread = threading.Thread(target=self._run, args=(smbus,), daemon=True,
+                                        name=f"i2c-bus-{bus}")
+        self._thread.start()
+
+    def _run(self, smbus):
+        while True:
+            with self._cond:
+                request = self._next()
+                while request is None:
+                    self._cond.wait()
+                    request = self._next()
+                if request.key is not None:
+                    self._pending_writes[request.key[0]].remove(request)
+            self._execute(smbus, request)
+
+    def _next(self):
+        for queue in self._queues:
+            while queue:
+                request = queue.popleft()
+                if not request.cancelled:
+                    return request
+        return None
+
+    def _execute(self, smbus, request):
+        if not request.future.set_running_or_notify_cancel():
+            return
+        if callable(request.method):
+            func = lambda *args: request.method(smbus, *args)
+        else:
+            func = getattr(smbus, request.method)
+        error = None
+        for _ in range(request.retry):
+            try:
+                result = func(*request.args)
+            except OSError as e:
+                self._debug(f"OSError: {request.method}")
+                error = e
+                continue
+            except Exception as e:
+                error = e
+                break
+            request.future.set_result(result)
+            return
+        request.future.set_exception(error)
+
+    def queue_depth(self):
+        """
+        Number of requests waiting to run, cancelled ones included
+
+        :return: queued request count
+        :rtype: int
+        """
+        return sum(len(queue) for queue in self._queues)
+
+    def submit(self, method, *args, priority=None, coalesce=False, retry=None):
+        """
+        Queue a SMBus call to run on the bus thread
+
+        :param method: SMBus method name, e.g. "write_word_data", or a function called with the SMBus and args
+        :type method: str/callable
+        :param args: SMBus method arguments, device address first
+        :param priority: URGENT, NORMAL or LOW, default to NORMAL or the urgent() block
+        :type priority: int
+        :param coalesce: a register write, drop queued writes this one overrides, see I2CBus
+        :type coalesce: bool
+        :param retry: attempts on OSError, default to RETRY
+        :type retry: int
+        :return: future of the SMBus call result
+        :rtype: concurrent.futures.Future
+        """
+        if priority is None:
+            priority = getattr(self._local, "priority", self.NORMAL)
+        key = None
+        if coalesce:
+            # address and the first and last register written
+            last = args[1] + max(len(args[2]), 1) - 1 if method == "write_i2c_block_data" else args[1]
+            key = (args[0], args[1], last)
+        if retry is None:
+            retry = self.RETRY
+        request = _Request(method, args, key, priority, retry)
+        with self._cond:
+            if key is not None:
+                pending = self._pending_writes.setdefault(key[0], [])
+                for old in list(pending):
+                    if old.key[2] < key[1] or old.key[1] > key[2]:
+                        continue
+                    covered = key[1] <= old.key[1] and old.key[2] <= key[2]
+                    if old.priority > priority or (old.priority == priority and covered):
+                        old.cancelled = True
+                        pending.remove(old)
+                        # None: superseded, False: registers this write doesn't cover were never written
+                        old.future.set_result(None if covered else False)
+                pending.append(request)
+            self._queues[priority].append(request)
+            self._cond.notify()
+        return request.future
+
+    def read_async(self, method, *args, priority=None):
+        """
+        Queue a SMBus read, see submit()
+
+        :return: future of the value read
+        :rtype: concurrent.futures.Future
+        """
+        return self.submit(method, *args, priority=priority)
+
+    def scan(self):
+        """
+        Probe the bus for devices, as one request on the bus thread
+
+        :return: addresses of the devices found
+        :rtype: list
+        """
+        return self.submit(scan_bus, retry=1).result()
+
+    def write_byte(self, address, data):
+        return self.submit("write_byte", address, data)
+
+    def write_byte_data(self, address, reg, data):
+        return self.submit("write_byte_data", address, reg, data, coalesce=True)
+
+    def write_word_data(self, address, reg, data):
+        return self.submit("write_word_data", address, reg, data, coalesce=True)
+
+    def write_i2c_block_data(self, address, reg, data):
+        return self.submit("write_i2c_block_data", address, reg, list(data), coalesce=True)
+
+    def read_byte(self, address):
+        return self.read_async("read_byte", address).result()
+
+    def read_byte_data(self, address, reg):
+        return self.read_async("read_byte_data", address, reg).result()
+
+    def read_word_data(self, address, reg):
+        return self.read_async("read_word_data", address, reg).result()
+
+    def read_i2c_block_data(self, address, reg, length):
+        return self.read_async("read_i2c_block_data", address, reg, length).result()
+
+    def close(self):
+        """The bus stays open for the other users, nothing to do"""
+        pass
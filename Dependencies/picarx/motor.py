@@ -88,19 +88,21 @@ class Motor():
             # dir = dir + 1 & 1
             dir = dir ^ 1 # XOR
         speed = abs(speed)
+        # stopping always reaches the MCU, whatever the pwm shadow says
+        force = speed == 0
 
         # mode 1: (TC1508S)
         if self.mode == 1:
-            self.pwm.pulse_width_percent(speed)
+            self.pwm.pulse_width_percent(speed, force)
             self.dir.value(dir)
         # mode 2: (TC618S)
         elif self.mode ==2:
             if dir == 1:
-                self.pwm_a.pulse_width_percent(speed)
-                self.pwm_b.pulse_width_percent(0)
+                self.pwm_a.pulse_width_percent(speed, force)
+                self.pwm_b.pulse_width_percent(0, force)
             else:
-                self.pwm_a.pulse_width_percent(0)
-                self.pwm_b.pulse_width_percent(speed)
+                self.pwm_a.pulse_width_percent(0, force)
+                self.pwm_b.pulse_width_percent(speed, force)
         # unkowned mode
         else:
             raise ValueError("Unkown motors mode")
@@ -1,5 +1,6 @@
-from robot_hat import Pin, ADC, PWM, Servo, fileDB
+from robot_hat import Pin, ADC, PWM, Servo, I2C, fileDB
 from robot_hat import Grayscale_Module, Ultrasonic, utils
+from robot_hat.i2c_bus import I2CBus
 import time
 import os
 
@@ -92,6 +93,16 @@ class Picarx(object):
         trig, echo= ultrasonic_pins
         self.ultrasonic = Ultrasonic(Pin(trig), Pin(echo, mode=Pin.IN, pull=Pin.PULL_DOWN))
         
+    def batch(self):
+        ''' batch servo/motor pwm writes into as few i2c transactions as possible
+
+        usage:
+            with px.batch():
+                px.set_dir_servo_angle(30)
+                px.forward(50)
+        '''
+        return I2C.batch()
+
     def set_motor_speed(self, motor, speed):
         ''' set motor speed
         
@@ -107,16 +118,18 @@ class Picarx(object):
         elif speed < 0:
             direction = -1 * self.cali_dir_value[motor]
         speed = abs(speed)
+        # stopping always reaches the MCU, whatever the pwm shadow says
+        stopping = speed == 0
         # print(f"direction: {direction}, speed: {speed}")
         if speed != 0:
             speed = int(speed /2 ) + 50
         speed = speed - self.cali_speed_value[motor]
         if direction < 0:
             self.motor_direction_pins[motor].high()
-            self.motor_speed_pins[motor].pulse_width_percent(speed)
+            self.motor_speed_pins[motor].pulse_width_percent(speed, force=stopping)
         else:
             self.motor_direction_pins[motor].low()
-            self.motor_speed_pins[motor].pulse_width_percent(speed)
+            self.motor_speed_pins[motor].pulse_width_percent(speed, force=stopping)
 
     def motor_speed_calibration(self, value):
         self.cali_speed_value = value
@@ -175,6 +188,10 @@ class Picarx(object):
         self.set_motor_speed(2, speed)
 
     def backward(self, speed):
+        with self.batch():
+            self._backward(speed)
+
+    def _backward(self, speed):
         current_angle = self.dir_current_angle
         if current_angle != 0:
             abs_current_angle = abs(current_angle)
@@ -192,6 +209,10 @@ class Picarx(object):
             self.set_motor_speed(2, speed)  
 
     def forward(self, speed):
+        with self.batch():
+            self._forward(speed)
+
+    def _forward(self, speed):
         current_angle = self.dir_current_angle
         if current_angle != 0:
             abs_current_angle = abs(current_angle)
@@ -210,11 +231,13 @@ class Picarx(object):
 
     def stop(self):
         '''
-        Execute twice to make sure it stops
+        Execute twice to make sure it stops, ahead of any queued i2c writes,
+        bypassing the pwm shadow so both writes go out
         '''
         for _ in range(2):
-            self.motor_speed_pins[0].pulse_width_percent(0)
-            self.motor_speed_pins[1].pulse_width_percent(0)
+            with I2CBus.urgent(), self.batch():
+                self.motor_speed_pins[0].pulse_width_percent(0, force=True)
+                self.motor_speed_pins[1].pulse_width_percent(0, force=True)
             time.sleep(0.002)
 
     def get_distance(self):
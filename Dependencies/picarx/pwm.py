@@ -1,8 +1,48 @@
 #!/usr/bin/env python3
 import math
+from functools import lru_cache
 from .i2c import I2C
 
-timer = [{"arr": 1} for _ in range(7)]
+# state of the 7 timers, shared by every channel on the timer
+# psc: None until the timer is programmed, target: frequency asked to freq(),
+# dirty: the MCU was reset since psc and arr were written
+timer = [{"arr": 1, "psc": None, "target": None, "dirty": False} for _ in range(7)]
+
+# last value written to each register, {(bus, address): {reg: value}}
+_shadow = {}
+# register writes sent to the bus vs. skipped because the value was unchanged
+_shadow_stats = {"issued": 0, "suppressed": 0}
+
+
+@lru_cache(maxsize=128)
+def solve_freq(freq, clock):
+    """
+    Find the prescaler and period giving the closest frequency
+
+    :param freq: frequency(Hz)
+    :type freq: int
+    :param clock: timer clock frequency(Hz)
+    :type clock: float
+    :return: prescaler, period, achieved frequency error(Hz)
+    :rtype: tuple
+    """
+    # [prescaler,arr] list
+    result_ap = []
+    # accuracy list
+    result_acy = []
+    # middle value for equal arr prescaler
+    st = int(math.sqrt(clock/freq))
+    # get -5 value as start
+    st -= 5
+    # prevent negetive value
+    if st <= 0:
+        st = 1
+    for psc in range(st, st+10):
+        arr = int(clock/freq/psc)
+        result_ap.append([psc, arr])
+        result_acy.append(abs(freq-clock/psc/arr))
+    i = result_acy.index(min(result_acy))
+    return result_ap[i][0], result_ap[i][1], result_acy[i]
 
 
 class PWM(I2C):
@@ -58,17 +98,80 @@ class PWM(I2C):
             self.timer_index = 6
 
         self._pulse_width = 0
-        self._freq = 50
-        self.freq(50)
+        _timer = timer[self.timer_index]
+        if _timer["psc"] is None:
+            self._freq = 50
+            self.freq(50)
+        else:
+            # another channel already set up this timer, keep its settings
+            self._restore_timer()
+            self._prescaler = _timer["psc"]
+            self._freq = self.CLOCK/_timer["psc"]/_timer["arr"]
 
         # print(f'PWM channel {channel} initialized')
         # print(f'PWM timer_index {self.timer_index}')
 
 
-    def _i2c_write(self, reg, value):
+    def _i2c_write(self, reg, value, force=False):
+        # force writes even if the register should already hold the value,
+        # for writes that must reach the MCU whatever we think it holds
+        shadow = _shadow.setdefault((self._bus, self.address), {})
+        if not force and shadow.get(reg) == value:
+            _shadow_stats["suppressed"] += 1
+            return
+        _shadow_stats["issued"] += 1
+        shadow[reg] = value
+
         value_h = value >> 8
         value_l = value & 0xff
-        self.write([reg, value_h, value_l])
+        if self._queue_word(reg, [value_h, value_l]):
+            return
+        self._check_write(self.write([reg, value_h, value_l]), {reg: [value_h, value_l]})
+
+    def _write_failed(self, regs):
+        super()._write_failed(regs)
+        # unknown register state, make sure the next write goes out,
+        # unless a newer value is already on its way
+        shadow = _shadow.get((self._bus, self.address), {})
+        for reg, (value_h, value_l) in regs.items():
+            if shadow.get(reg) == (value_h << 8) | value_l:
+                shadow.pop(reg, None)
+
+    @staticmethod
+    def shadow_stats():
+        """
+        Get register write counters
+
+        :return: {"issued": writes sent to the bus, "suppressed": writes skipped because the register already held the value}
+        :rtype: dict
+        """
+        return dict(_shadow_stats)
+
+    @staticmethod
+    def clear_shadow():
+        """
+        Forget all cached register values, call this after the MCU is reset
+
+        Timer settings are kept and written again the next time a channel of the timer is used.
+        """
+        _shadow.clear()
+        for _timer in timer:
+            _timer["dirty"] = _timer["psc"] is not None
+
+    def _restore_timer(self):
+        # write back the prescaler and period the MCU lost in a reset
+        _timer = timer[self.timer_index]
+        if not _timer["dirty"]:
+            return
+        _timer["dirty"] = False
+        if self.timer_index < 4:
+            psc_reg = self.REG_PSC + self.timer_index
+            arr_reg = self.REG_ARR + self.timer_index
+        else:
+            psc_reg = self.REG_PSC2 + self.timer_index - 4
+            arr_reg = self.REG_ARR2 + self.timer_index - 4
+        self._i2c_write(psc_reg, _timer["psc"]-1)
+        self._i2c_write(arr_reg, _timer["arr"])
 
     def freq(self, freq=None):
         """
@@ -82,28 +185,31 @@ class PWM(I2C):
         if freq == None:
             return self._freq
 
-        self._freq = int(freq)
-        # [prescaler,arr] list
-        result_ap = []
-        # accuracy list
-        result_acy = []
-        # middle value for equal arr prescaler
-        st = int(math.sqrt(self.CLOCK/self._freq))
-        # get -5 value as start
-        st -= 5
-        # prevent negetive value
-        if st <= 0:
-            st = 1
-        for psc in range(st, st+10):
-            arr = int(self.CLOCK/self._freq/psc)
-            result_ap.append([psc, arr])
-            result_acy.append(abs(self._freq-self.CLOCK/psc/arr))
-        i = result_acy.index(min(result_acy))
-        psc = result_ap[i][0]
-        arr = result_ap[i][1]
+        self._restore_timer()
+        target = int(freq)
+        psc, arr, _ = solve_freq(target, self.CLOCK)
         self._debug(f"prescaler: {psc}, period: {arr}")
-        self.prescaler(psc)
-        self.period(arr)
+        _timer = timer[self.timer_index]
+        if _timer["psc"] == psc and _timer["arr"] == arr:
+            # timer already runs at this frequency
+            self._prescaler = psc
+            self._freq = self.CLOCK/psc/arr
+        else:
+            self.prescaler(psc)
+            self.period(arr)
+        _timer["target"] = target
+
+    def freq_error(self):
+        """
+        Get the difference between the frequency asked to freq() and the one the timer achieves
+
+        :return: frequency error(Hz), 0 if the timer was set with prescaler()/period()
+        :rtype: float
+        """
+        _timer = timer[self.timer_index]
+        if _timer["target"] is None:
+            return 0.0
+        return abs(_timer["target"] - self.CLOCK/_timer["psc"]/_timer["arr"])
 
     def prescaler(self, prescaler=None):
         """
@@ -115,9 +221,12 @@ class PWM(I2C):
         :rtype: int
         """
         if prescaler == None:
-            return self._prescaler
+            return timer[self.timer_index]["psc"]
 
+        self._restore_timer()
         self._prescaler = round(prescaler)
+        timer[self.timer_index]["psc"] = self._prescaler
+        timer[self.timer_index]["target"] = None
         self._freq = self.CLOCK/self._prescaler/timer[self.timer_index]["arr"]
         if self.timer_index < 4:
             reg = self.REG_PSC + self.timer_index
@@ -139,8 +248,10 @@ class PWM(I2C):
         if arr == None:
             return timer[self.timer_index]["arr"]
 
+        self._restore_timer()
         timer[self.timer_index]["arr"] = round(arr)
-        self._freq = self.CLOCK/self._prescaler/timer[self.timer_index]["arr"]
+        timer[self.timer_index]["target"] = None
+        self._freq = self.CLOCK/timer[self.timer_index]["psc"]/timer[self.timer_index]["arr"]
 
         if self.timer_index < 4:
             reg = self.REG_ARR + self.timer_index
@@ -150,28 +261,33 @@ class PWM(I2C):
         self._debug(f"Set arr to: {timer[self.timer_index]['arr']}")
         self._i2c_write(reg, timer[self.timer_index]["arr"])
 
-    def pulse_width(self, pulse_width=None):
+    def pulse_width(self, pulse_width=None, force=False):
         """
         Set/get pulse width, leave blank to get pulse width
 
         :param pulse_width: pulse width(0-65535)
         :type pulse_width: float
+        :param force: write even if the channel already holds this value, e.g. to stop motors
+        :type force: bool
         :return: pulse width
         :rtype: float
         """
         if pulse_width == None:
             return self._pulse_width
 
+        self._restore_timer()
         self._pulse_width = int(pulse_width)
         reg = self.REG_CHN + self.channel
-        self._i2c_write(reg, self._pulse_width)
+        self._i2c_write(reg, self._pulse_width, force)
 
-    def pulse_width_percent(self, pulse_width_percent=None):
+    def pulse_width_percent(self, pulse_width_percent=None, force=False):
         """
         Set/get pulse width percentage, leave blank to get pulse width percentage
 
         :param pulse_width_percent: pulse width percentage(0-100)
         :type pulse_width_percent: float
+        :param force: write even if the channel already holds this value, e.g. to stop motors
+        :type force: bool
         :return: pulse width percentage
         :rtype: float
         """
@@ -182,7 +298,7 @@ class PWM(I2C):
         self._pulse_width_percent = pulse_width_percent
         temp = self._pulse_width_percent / 100.0
         pulse_width = temp * timer[self.timer_index]["arr"]
-        self.pulse_width(pulse_width)
+        self.pulse_width(pulse_width, force)
 
 
 def test():
@@ -154,6 +154,10 @@ def reset_mcu():
 
     mcu_reset.close()
 
+    # registers are back to their power-on values
+    from .pwm import PWM
+    PWM.clear_shadow()
+
 
 def get_battery_voltage():
     """
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+from urllib.parse import parse_qs, urlsplit
+from frame_broadcast import ClientLimit, VideoSlot
+from stream_metrics import report
+from websocket_frames import handshake_response
+
+STREAM_HEADERS = (
+    b'HTTP/1.0 200 OK\r\n'
+    b'Age: 0\r\n'
+    b'Cache-Control: no-cache, private\r\n'
+    b'Pragma: no-cache\r\n'
+    b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n'
+    b'\r\n')
+
+
+class AsyncClientSlot:
+    """Latest-frame-only mailbox of one asyncio client, used from the event loop only"""
+
+    def __init__(self):
+        self._frame = None
+        self._ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.backlog = 0
+        self.lag = None
+
+    def put(self, frame):
+        if self._frame is not None:
+            self.dropped += 1
+        self._frame = frame
+        self._ready.set()
+
+    async def get(self):
+        await self._ready.wait()
+        self._ready.clear()
+        frame, self._frame = self._frame, None
+        self.sent += 1
+        return frame
+
+
+class AsyncVideoSlot(VideoSlot):
+    """VideoSlot an event loop can wait on, filled from the encoder thread"""
+
+    def __init__(self, loop, **kwargs):
+        super().__init__(**kwargs)
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def put(self, frame):
+        super().put(frame)
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def get_async(self):
+        while True:
+            frame = self.get(0)
+            if frame is not None:
+                return frame
+            await self._event.wait()
+            self._event.clear()
+
+
+class AsyncFanout:
+    """Moves frames from the encoder thread into the event loop
+
+    Subscribed to the FrameBroadcaster once for all asyncio clients, so
+    each frame costs one loop wakeup however many clients are connected.
+    slots is replaced rather than changed, so other threads, such as the
+    StreamController counting clients, can iterate it safely.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self.slots = frozenset()
+
+    def add(self, slot):
+        self.slots = self.slots | {slot}
+
+    def discard(self, slot):
+        self.slots = self.slots - {slot}
+
+    def put(self, frame):
+        self._loop.call_soon_threadsafe(self._dispatch, frame)
+
+    def _dispatch(self, frame):
+        for slot in self.slots:
+            slot.put(frame)
+
+
+class AsyncStreamingServer:
+    """Single threaded MJPEG server on non-blocking sockets
+
+    Serves the same routes as StreamingHandler. A client that drains
+    slower than the camera produces only ever has one frame waiting for
+    it, the rest are dropped while its socket buffer is full.
+    """
+
+    def __init__(self, streams, pages, video=None, recorder=None, max_clients=10, write_buffer=256 * 1024):
+        """
+        :param streams: ?res= value to the stream serving it
+        :type streams: dict of StreamController
+        :param pages: path to HTML content, e.g. /index.html
+        :type pages: dict
+        :param video: H.264 stream served on /video.h264, None to disable
+        :type video: H264Stream
+        :param recorder: recorder controlled on /record, None to disable
+        :type recorder: Recorder
+        :param max_clients: HTTP and WebSocket streaming clients served at once, more get a 503
+        :type max_clients: int
+        :param write_buffer: bytes queued per client before waiting for it to drain
+        :type write_buffer: int
+        """
+        self.streams = streams
+        self.pages = {path: page.encode('utf-8') for path, page in pages.items()}
+        self.video = video
+        self.recorder = recorder
+        self.viewers = ClientLimit(max_clients)
+        self.write_buffer = write_buffer
+        self._fanouts = {}
+
+    def serve_forever(self, address):
+        asyncio.run(self.serve(address))
+
+    async def serve(self, address):
+        loop = asyncio.get_running_loop()
+        for res, stream in self.streams.items():
+            self._fanouts[res] = AsyncFanout(loop)
+            stream.output.subscribe(self._fanouts[res])
+        try:
+            srv = await asyncio.start_server(self._handle, *address)
+            async with srv:
+                await srv.serve_forever()
+        finally:
+            for res, stream in self.streams.items():
+                stream.output.unsubscribe(self._fanouts[res])
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            lines = request.decode('latin-1').split('\r\n')
+            method, path = lines[0].split(' ', 2)[:2]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(': ')
+                headers[name.lower()] = value
+            url = urlsplit(path)
+            res = parse_qs(url.query).get('res', ['high'])[0]
+            if method != 'GET':
+                await self._respond(writer, b'405 Method Not Allowed')
+            elif url.path in ('/stream.mjpg', '/frame.jpg') and res not in self.streams:
+                await self._respond(writer, b'404 Not Found')
+            elif path == '/':
+                await self._respond(writer, b'301 Moved Permanently', [b'Location: /index.html'])
+            elif path in self.pages:
+                await self._respond(writer, b'200 OK', [b'Content-Type: text/html'], self.pages[path])
+            elif path == '/video.h264' and self.video is not None and 'sec-websocket-key' in headers:
+                await self._video(writer, headers['sec-websocket-key'])
+            elif path == '/metrics':
+                await self._respond(writer, b'200 OK', [b'Content-Type: application/json'],
+                                    report(self.streams, self.video))
+            elif url.path == '/record' and self.recorder is not None:
+                action = parse_qs(url.query).get('action', [None])[0]
+                if action == 'start':
+                    self.recorder.trigger('manual')
+                elif action == 'stop':
+                    self.recorder.stop_recording()
+                elif action == 'trigger':
+                    self.recorder.trigger('trigger', self.recorder.post_roll)
+                await self._respond(writer, b'200 OK', [b'Content-Type: application/json'], self.recorder.status())
+            elif url.path == '/frame.jpg':
+                await self._snapshot(writer, res)
+            elif url.path == '/stream.mjpg':
+                await self._stream(writer, res)
+            else:
+                await self._respond(writer, b'404 Not Found')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        except ConnectionError as e:
+            logging.warning(
+                'Removed streaming client %s: %s',
+                writer.get_extra_info('peername'), str(e))
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, headers=(), body=b''):
+        head = [b'HTTP/1.0 ' + status]
+        head.extend(headers)
+        head.append(b'Content-Length: ' + str(len(body)).encode())
+        writer.write(b'\r\n'.join(head) + b'\r\n\r\n' + body)
+        await writer.drain()
+
+    async def _snapshot(self, writer, res):
+        # may wait for a paused encoder to start, keep that off the event loop
+        loop = asyncio.get_running_loop()
+        frame = await loop.run_in_executor(None, self.streams[res].snapshot)
+        if frame is None:
+            await self._respond(writer, b'503 Service Unavailable')
+        else:
+            await self._respond(
+                writer, b'200 OK', [b'Cache-Control: no-cache, private', b'Content-Type: image/jpeg'], frame.data)
+
+    async def _video(self, writer, key):
+        if not self.viewers.acquire():
+            await self._respond(writer, b'503 Service Unavailable')
+            return
+        try:
+            await self._send_video(writer, key)
+        finally:
+            self.viewers.release()
+
+    async def _send_video(self, writer, key):
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+        writer.write(handshake_response(key))
+        loop = asyncio.get_running_loop()
+        # subscribing may start the encoder, keep that off the event loop
+        slot = await loop.run_in_executor(None, self.video.subscribe, AsyncVideoSlot(
+            loop, on_resync=self.video.request_keyframe))
+        try:
+            while True:
+                frame = await slot.get_async()
+                writer.writelines(frame.buffers())
+                await writer.drain()
+                self.video.metrics.sent(slot, frame, writer.transport.get_write_buffer_size())
+        finally:
+            await loop.run_in_executor(None, self.video.unsubscribe, slot)
+
+    async def _stream(self, writer, res):
+        if not self.viewers.acquire():
+            await self._respond(writer, b'503 Service Unavailable')
+            return
+        try:
+            await self._send_stream(writer, res)
+        finally:
+            self.viewers.release()
+
+    async def _send_stream(self, writer, res):
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+        writer.write(STREAM_HEADERS)
+        slot = AsyncClientSlot()
+        fanout = self._fanouts[res]
+        output = self.streams[res].output
+        fanout.add(slot)
+        self.streams[res].wake()
+        try:
+            while True:
+                frame = await slot.get()
+                writer.writelines(frame.buffers())
+                # waits while the client's buffer is above write_buffer, newer frames replace the waiting one meanwhile
+                await writer.drain()
+                output.metrics.sent(slot, frame, writer.transport.get_write_buffer_size())
+        finally:
+            fanout.discard(slot)
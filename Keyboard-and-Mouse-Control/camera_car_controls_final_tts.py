@@ -2,10 +2,18 @@ from flask import Flask, render_template, Blueprint
 from flask_sock import Sock
 from picarx import Picarx
 from robot_hat import Music, TTS
+from control_loop import ControlLoop
+import protocol
+from keystate import KeyState
+from deadline import DeadlineScheduler
+from recording import RECORD_COMMANDS, request_recording
 import threading
 import readchar
 
 px = Picarx()
+# hardware is only written from the control loop, at a fixed rate
+control = ControlLoop(px, rate=100)
+control.start()
 music = Music()
 tts = TTS()
 
@@ -15,6 +23,11 @@ app = Flask("")
 sock = Sock(app)
 
 flag_bgm = False
+# send every received message back to the client, clients can also ask per message with FLAG_ECHO
+ECHO = False
+# stop the car if no message (the page pings every 250 ms) arrives for this long, seconds
+LINK_TIMEOUT = 1.0
+deadlines = DeadlineScheduler()
 music.music_set_volume(20)
 tts.lang("en-US")
 
@@ -30,37 +43,20 @@ def index():
 # FUNCTIONS FOR MOVEMENT                                       #
 # ------------------------------------------------------------ #
 
-def moveForward(speed):
-    speed = speed + 0.25
-    px.set_dir_servo_angle(0)
-    px.forward(speed)
-    
-def moveBackward(speed):
-    speed = speed + 0.25
-    px.set_dir_servo_angle(0)
-    px.backward(speed)
-    
-def rightTurn():
-    px.set_dir_servo_angle(30)
-    
-def leftTurn():
-    px.set_dir_servo_angle(-30)
-
-def moveCombinedForward(speed, direction_angle):
-    speed = speed + 0.25
-    px.set_dir_servo_angle(direction_angle)
-    px.forward(speed)
-        
-def moveCombinedBackward(speed, direction_angle):
-    speed = speed + 0.25
-    px.set_dir_servo_angle(direction_angle)
-    px.backward(speed)
-
-def slowDown(speed):
-    if speed > 0:
-        speed = speed - 0.25
-    else:
-        px.stop()
+def drive(action):
+    # action is (direction, steering) from the key state table, None leaves a value as is
+    direction, steering = action
+    state = {}
+    if direction is not None:
+        state["speed"] = direction * (speed + 0.25)
+    if steering is not None:
+        state["steering"] = steering
+    control.set(**state)
+
+def link_lost():
+    print("No message from the client, stopping")
+    keys.release_all()
+    control.halt()
 
 # ------------------------------------------------------------ #
 # FUNCTIONS FOR CAMERA MOVEMENT                                #
@@ -72,25 +68,23 @@ def remap_value(oldVal, oldMin, oldMax, newMin, newMax):
     newVal = (((oldVal - oldMin) * newRange) / oldRange) + newMin
     return newVal
 
-def move_camera(dataList):
-    if (dataList[0] == "mm"):
-        coordinates = dataList[1].split(" ")
-        Mouse_X = int(coordinates[0])
-        OldMax_X = int(coordinates[2])
+def move_camera(cmd):
+    if cmd.op == protocol.OP_MOUSE:
+        coordinates = cmd.axes
+        Mouse_X = coordinates[0]
+        OldMax_X = coordinates[2]
         OldMin_X = 0
         NewMax_X = 180
         NewMin_X = -180
         NewValue_X = remap_value(Mouse_X, OldMin_X, OldMax_X, NewMin_X, NewMax_X)
-        print(NewValue_X)
-        Mouse_Y = int(coordinates[1])
+        Mouse_Y = coordinates[1]
         OldMax_Y = 0
-        OldMin_Y = int(coordinates[3])
+        OldMin_Y = coordinates[3]
         NewMax_Y = 180
         NewMin_Y = -180
         NewValue_Y = remap_value(Mouse_Y, OldMin_Y, OldMax_Y, NewMin_Y, NewMax_Y)
-        px.set_cam_pan_angle(NewValue_X)
-        px.set_cam_tilt_angle(NewValue_Y)
-        print(NewValue_Y)
+        # latched, the control loop rate-limits and deduplicates servo writes
+        control.set(pan=NewValue_X, tilt=NewValue_Y)
     else:
         pass
 
@@ -98,130 +92,60 @@ def move_camera(dataList):
 # TTS FUNCTION                                                 #
 # ------------------------------------------------------------ #
 
-def speak(dataList):
-    if dataList[0] == "sent":
-        if dataList[1] == "music":
+def speak(cmd):
+    if cmd.op == protocol.OP_TEXT:
+        if cmd.text == "music":
             music.music_play("cameraCarSounds/tunak.mp3")
-        elif dataList[1] == "stop":
+        elif cmd.text == "stop":
             music.music_stop()
+        elif cmd.text in RECORD_COMMANDS:
+            request_recording(RECORD_COMMANDS[cmd.text])
         else:
-            tts.say(dataList[1])
+            tts.say(cmd.text)
     
-keyHistory = []
+keys = KeyState()
 speed = 0
 
 @sock.route('/echo')
 def echo(sock):
+    try:
+        serve_client(sock)
+    finally:
+        deadlines.cancel("link")
+        link_lost()
+
+def serve_client(sock):
     while True:
-        print(keyHistory)
         data = sock.receive()
-        print("GOT data: " + data)
-        sock.send(data + " from Python!!")
-        dataList = data.split(":")
+        cmd = protocol.parse(data)
+        if cmd is None:
+            print("Unknown data: " + repr(data))
+            continue
+        deadlines.arm("link", LINK_TIMEOUT, link_lost)
+        if cmd.op == protocol.OP_PING:
+            continue
+        print("GOT data: " + repr(cmd))
+        if ECHO or cmd.flags & protocol.FLAG_ECHO:
+            sock.send(data + " from Python!!" if isinstance(data, str) else data)
         
         # ------------------------------------------------------------ #
         # TTS SPEECH                                                   #
         # ------------------------------------------------------------ #
         
-        speak(dataList)
+        speak(cmd)
         
         # ------------------------------------------------------------ #
         # CAMERA MOVEMENT                                              #
         # ------------------------------------------------------------ #
         
-        move_camera(dataList)
-        
-        # ------------------------------------------------------------ #
-        # MOVE FORWARD                                                 #
-        # ------------------------------------------------------------ #
-        
-        # Receive data
-        if data == 'forward:1':
-            if not 'forward:1' in keyHistory:
-                keyHistory.append('forward:1')
-        # Remove forward from list so action of turning wheel is not affected by forward if statement
-        elif data == 'forward:0':
-            if 'forward:1' in keyHistory:
-                keyHistory.pop(keyHistory.index('forward:1'))
-        else:
-            pass
+        move_camera(cmd)
         
-        
-        # ------------------------------------------------------------ #
-        # MOVE BACKWARD                                                #
-        # ------------------------------------------------------------ #
-        
-        # Receive data
-        if data == 'backward:1':
-            if not 'backward:1' in keyHistory:
-                keyHistory.append('backward:1')
-        #Remove backward from list so action of turning wheel is not affected by backward if statement
-        elif data == 'backward:0':
-            if 'backward:1' in keyHistory:
-                keyHistory.pop(keyHistory.index('backward:1'))
-        else:
-            pass
-           
-
-        # ------------------------------------------------------------ #
-        # RIGHT TURN                                                   #
-        # ------------------------------------------------------------ #
-        
-        # Receive data
-        if data == 'right:1':
-            if not 'right:1' in keyHistory:
-                keyHistory.append('right:1')
-        #Remove right from list so other actions dont get activated
-        elif data == 'right:0':
-            if 'right:1' in keyHistory:
-                keyHistory.pop(keyHistory.index('right:1'))
-        else:
-            pass
-        
-
-        
-        # ------------------------------------------------------------ #
-        # LEFT TURN                                                    #
-        # ------------------------------------------------------------ #
-            
-        #Turn wheels left
-        if data == 'left:1':
-            if not 'left:1' in keyHistory:
-                keyHistory.append('left:1')
-        #Remove left from list so other actions dont get activated
-        elif data == 'left:0':
-            if 'left:1' in keyHistory:
-                keyHistory.pop(keyHistory.index('left:1'))
-        else:
-            pass
-        
-
-            
         # ------------------------------------------------------------ #
         # WHEEL MOVEMENT                                               #
         # ------------------------------------------------------------ #
-
-        if "forward:1" in keyHistory and not "right:1" in keyHistory and not "left:1" in keyHistory:
-            moveForward(speed)
-        elif "backward:1" in keyHistory and not "right:1" in keyHistory and not "left:1" in keyHistory:
-            moveBackward(speed)
-        elif "right:1" in keyHistory and not "forward:1" in keyHistory and not "backward:1" in keyHistory:
-            rightTurn()
-        elif "left:1" in keyHistory and not "forward:1" in keyHistory and not "backward:1" in keyHistory:
-            leftTurn()
-        elif 'forward:1' in keyHistory and 'right:1' in keyHistory:
-            print('Accelerating right')
-            moveCombinedForward(speed, 30)
-        elif 'forward:1' in keyHistory and 'left:1' in keyHistory:
-            print('Accelerating left')
-            moveCombinedForward(speed, -30)
-        elif 'backward:1' in keyHistory and 'right:1' in keyHistory:
-            print('Accelerating backwards right')
-            moveCombinedBackward(speed, 30)
-        elif 'backward:1' in keyHistory and 'left:1' in keyHistory:
-            print('Accelerating backwards left')
-            moveCombinedBackward(speed, -30)
-        else:
-            slowDown(speed)
+        
+        if keys.update(cmd):
+            print(keys)
+            drive(keys.action())
             
 app.run(host="raspberry pi ip")
@@ -1,13 +1,52 @@
 # Run this script, then point a web browser at http:<this-ip-address>:8000).
 
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
 from picamera2.encoders import JpegEncoder
-from picamera2.outputs import FileOutput
-import io
+import argparse
 import logging
 import socketserver
-from threading import Condition, Thread
 from http import server
+from urllib.parse import parse_qs, urlsplit
+from frame_broadcast import ClientLimit, FrameBroadcaster, send_buffers, unsent_bytes
+from async_stream_server import AsyncStreamingServer
+from stream_control import LEVELS, CameraRate, StreamController
+from h264_stream import BroadcastOutput, H264Stream, make_encoder
+from websocket_frames import handshake_response
+from frame_ring import FrameRingWriter, RingPublisher
+from stream_metrics import boot_to_wall, report
+from recorder import MotionDetector, Recorder
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mode', choices=('threaded', 'asyncio'), default='threaded',
+                    help='one thread per client, or every client on one event loop')
+parser.add_argument('--max-clients', type=int, default=10,
+                    help='HTTP and WebSocket streaming clients served at once, more get a 503')
+parser.add_argument('--h264', action='store_true',
+                    help='also serve H.264 over a WebSocket on /video.h264, watch it on /video.html')
+parser.add_argument('--h264-bitrate', type=int, default=2000000)
+parser.add_argument('--keyframe-interval', type=int, default=30,
+                    help='frames between H.264 keyframes')
+parser.add_argument('--software-h264', action='store_true',
+                    help='use the libav encoder even if the hardware one is available')
+parser.add_argument('--ring', choices=('off', 'raw', 'jpeg'), default='off',
+                    help='publish raw or JPEG frames to shared memory for local readers, see frame_ring.py')
+parser.add_argument('--ring-res', choices=('high', 'low'), default='low',
+                    help='stream published to shared memory')
+parser.add_argument('--ring-slots', type=int, default=8,
+                    help='frames kept in shared memory')
+parser.add_argument('--record', choices=('off', 'high', 'low'), default='off',
+                    help='keep a pre-roll of this stream and record it on /record or on motion')
+parser.add_argument('--record-dir', default='recordings')
+parser.add_argument('--pre-roll', type=float, default=5.0,
+                    help='seconds before a trigger included in the recording')
+parser.add_argument('--post-roll', type=float, default=10.0,
+                    help='seconds recorded after the last trigger')
+parser.add_argument('--motion-threshold', type=float, default=8.0,
+                    help='mean luma change (0-255) of the lores stream that triggers a recording, 0 disables')
+args = parser.parse_args()
+
+RESOLUTIONS = {'high': ('main', (1280, 720)), 'low': ('lores', (640, 360))}
+"""?res= value: camera stream and size, both come from the same capture"""
 
 PAGE = """\
 <html>
@@ -16,58 +55,154 @@ PAGE = """\
 </head>
 <body>
 <h1>Picamera2 MJPEG Streaming Demo</h1>
-<img src="stream.mjpg" width="1920" height="1080" />
+<img src="stream.mjpg?res=high" width="1280" height="720" />
 </body>
 </html>
 """
 
+VIDEO_PAGE = """\
+<html>
+<head>
+<title>picamera2 H.264 streaming demo</title>
+</head>
+<body>
+<h1>Picamera2 H.264 Streaming Demo</h1>
+<canvas id="video" width="1280" height="720"></canvas>
+<script>
+    // each message is a flags byte (1 = keyframe) followed by Annex-B H.264
+    const canvas = document.getElementById("video");
+    const ctx = canvas.getContext("2d");
+    const decoder = new VideoDecoder({
+        output: (frame) => {
+            ctx.drawImage(frame, 0, 0, canvas.width, canvas.height);
+            frame.close();
+        },
+        error: (e) => console.log(e),
+    });
+    decoder.configure({codec: "avc1.640028", optimizeForLatency: true});
+    const ws = new WebSocket("ws://" + location.host + "/video.h264");
+    ws.binaryType = "arraybuffer";
+    let timestamp = 0;
+    ws.onmessage = (e) => {
+        const data = new Uint8Array(e.data);
+        const keyframe = data[0] & 1;
+        decoder.decode(new EncodedVideoChunk({
+            type: keyframe ? "key" : "delta",
+            timestamp: timestamp++,
+            data: data.subarray(1),
+        }));
+    };
+</script>
+</body>
+</html>
+"""
+
+PAGES = {'/index.html': PAGE}
+if args.h264:
+    PAGES['/video.html'] = VIDEO_PAGE
 
-class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
-        self.frame = None
-        self.condition = Condition()
 
-    def write(self, buf):
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
+viewers = ClientLimit(args.max_clients)
 
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path == '/':
+        url = urlsplit(self.path)
+        res = parse_qs(url.query).get('res', ['high'])[0]
+        stream = streams.get(res)
+        if url.path in ('/stream.mjpg', '/frame.jpg') and stream is None:
+            self.send_error(404)
+        elif self.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
-        elif self.path == '/index.html':
-            content = PAGE.encode('utf-8')
+        elif self.path in PAGES:
+            content = PAGES[self.path].encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path == '/stream.mjpg':
+        elif self.path == '/metrics':
+            content = report(streams, video)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif url.path == '/record' and recorder is not None:
+            action = parse_qs(url.query).get('action', [None])[0]
+            if action == 'start':
+                recorder.trigger('manual')
+            elif action == 'stop':
+                recorder.stop_recording()
+            elif action == 'trigger':
+                recorder.trigger('trigger', recorder.post_roll)
+            content = recorder.status()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif url.path == '/frame.jpg':
+            frame = stream.snapshot()
+            if frame is None:
+                self.send_error(503)
+                return
             self.send_response(200)
-            self.send_header('Age', 0)
             self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', len(frame.data))
             self.end_headers()
+            self.wfile.write(frame.data)
+        elif self.path == '/video.h264' and video is not None and 'Sec-WebSocket-Key' in self.headers:
+            if not viewers.acquire():
+                self.send_error(503)
+                return
+            try:
+                self.wfile.write(handshake_response(self.headers['Sec-WebSocket-Key']))
+                slot = video.subscribe()
+                try:
+                    while True:
+                        frame = slot.get()
+                        send_buffers(self.connection, frame.buffers())
+                        video.metrics.sent(slot, frame, unsent_bytes(self.connection))
+                except Exception as e:
+                    logging.warning(
+                        'Removed video client %s: %s',
+                        self.client_address, str(e))
+                finally:
+                    video.unsubscribe(slot)
+            finally:
+                viewers.release()
+        elif url.path == '/stream.mjpg':
+            if not viewers.acquire():
+                self.send_error(503)
+                return
             try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
+                self.send_response(200)
+                self.send_header('Age', 0)
+                self.send_header('Cache-Control', 'no-cache, private')
+                self.send_header('Pragma', 'no-cache')
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+                self.end_headers()
+                output = stream.output
+                slot = output.subscribe()
+                stream.wake()
+                try:
+                    while True:
+                        frame = slot.get()
+                        # part header, JPEG and trailer in one sendmsg, no copies
+                        send_buffers(self.connection, frame.buffers())
+                        output.metrics.sent(slot, frame, unsent_bytes(self.connection))
+                except Exception as e:
+                    logging.warning(
+                        'Removed streaming client %s: %s',
+                        self.client_address, str(e))
+                finally:
+                    output.unsubscribe(slot)
+            finally:
+                viewers.release()
         else:
             self.send_error(404)
             self.end_headers()
@@ -79,14 +214,69 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
 
 
 picam2 = Picamera2()
-picam2.configure(picam2.create_video_configuration(main={"size": (640, 480)}))
-output = StreamingOutput()
-picam2.start_recording(JpegEncoder(), FileOutput(output))
+picam2.configure(picam2.create_video_configuration(
+    **{name: {"size": size} for name, size in RESOLUTIONS.values()}))
+picam2.start()
+rate = CameraRate(picam2)
+streams = {}
+for res, (name, size) in RESOLUTIONS.items():
+    output = FrameBroadcaster()
+    # one encoder per camera stream, each only runs while its stream has clients
+    encoder = JpegEncoder(q=LEVELS[0].quality)
+    streams[res] = StreamController(
+        picam2, encoder, BroadcastOutput(output, encoder), output, name=name, rate=rate)
+    streams[res].start()
+post_callbacks = []
+
+
+def run_post_callbacks(request):
+    for callback in post_callbacks:
+        callback(request)
+
+
+picam2.post_callback = run_post_callbacks
+
+ring = None
+if args.ring != 'off':
+    ring_name, (width, height) = RESOLUTIONS[args.ring_res]
+    if args.ring == 'raw':
+        config = picam2.stream_configuration(ring_name)
+        ring = FrameRingWriter(config['framesize'], args.ring_slots,
+                               f"{config['format']} {width}x{height} stride {config['stride']}")
+
+        def publish_raw(request):
+            captured = boot_to_wall(request.get_metadata()['SensorTimestamp'] / 1000)
+            with MappedArray(request, ring_name) as m:
+                ring.write(m.array, captured)
+        post_callbacks.append(publish_raw)
+    else:
+        # JPEGs are at most about one byte per pixel
+        ring = FrameRingWriter(width * height, args.ring_slots, f"jpeg {width}x{height}")
+        streams[args.ring_res].output.subscribe(RingPublisher(ring))
+recorder = None
+if args.record != 'off':
+    # the pre-roll needs frames all the time, so the recorded stream is never paused
+    recorder = Recorder(streams[args.record].output, args.record_dir, args.pre_roll, args.post_roll)
+    recorder.start()
+    if args.motion_threshold > 0:
+        post_callbacks.append(MotionDetector(recorder, RESOLUTIONS['low'][1], threshold=args.motion_threshold))
+video = None
+if args.h264:
+    video = H264Stream(picam2, make_encoder(args.h264_bitrate, args.keyframe_interval, args.software_h264),
+                       name='main', rate=rate)
 
 try:
     address = ('', 8000)
-    server = StreamingServer(address, StreamingHandler)
-    server.serve_forever()
+    if args.mode == 'asyncio':
+        AsyncStreamingServer(streams, PAGES, video, recorder, max_clients=args.max_clients).serve_forever(address)
+    else:
+        server = StreamingServer(address, StreamingHandler)
+        server.serve_forever()
 finally:
-    
+    for stream in streams.values():
+        stream.stop()
+    if recorder is not None:
+        recorder.stop()
     picam2.stop_recording()
+    if ring is not None:
+        ring.close()
@@ -0,0 +1,243 @@
+import collections
+import fcntl
+import io
+import struct
+import termios
+import threading
+import time
+from stream_metrics import StreamMetrics
+from websocket_frames import frame_header
+
+FLAG_KEYFRAME = 0x01
+"""Flags byte in front of every H.264 message"""
+
+
+class Frame:
+    """One encoded JPEG, shared by every client that sends it
+
+    seq counts frames from 1, captured and encoded are wall clock times
+    the sensor took the frame and the encoder handed it over.
+    """
+    __slots__ = ("data", "seq", "captured", "encoded", "header")
+
+    def __init__(self, data, seq=0, captured=None, encoded=None):
+        self.data = data
+        self.seq = seq
+        self.encoded = time.time() if encoded is None else encoded
+        self.captured = self.encoded if captured is None else captured
+        # multipart part header, built once per frame rather than once per client
+        self.header = (
+            b'--FRAME\r\n'
+            b'Content-Type: image/jpeg\r\n'
+            b'Content-Length: ' + str(len(data)).encode() + b'\r\n'
+            b'X-Seq: ' + str(seq).encode() + b'\r\n'
+            b'X-Timestamp: ' + f'{self.captured:.6f}'.encode() + b'\r\n'
+            b'\r\n')
+
+    def buffers(self):
+        """Part header, JPEG and part trailer, ready for sendmsg()"""
+        return [self.header, memoryview(self.data), b'\r\n']
+
+
+class ClientSlot:
+    """Latest-frame-only mailbox of one client
+
+    A new frame replaces one the client has not picked up yet, so a slow
+    client skips frames instead of queueing them.
+    """
+
+    def __init__(self):
+        self._frame = None
+        self._ready = threading.Event()
+        self.sent = 0
+        self.dropped = 0
+        # bytes queued in the client's socket and age of the last frame sent, updated by whoever sends to it
+        self.backlog = 0
+        self.lag = None
+
+    def put(self, frame):
+        if self._frame is not None:
+            self.dropped += 1
+        self._frame = frame
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """Wait for the next frame, None on timeout"""
+        while self._ready.wait(timeout):
+            self._ready.clear()
+            frame, self._frame = self._frame, None
+            # None if a put() raced with the previous get() and was already taken
+            if frame is not None:
+                self.sent += 1
+                return frame
+        return None
+
+
+class VideoFrame:
+    """One encoded access unit (Annex-B), shared by every client that sends it"""
+    __slots__ = ("data", "keyframe", "seq", "captured", "encoded", "header")
+
+    def __init__(self, data, keyframe, seq=0, captured=None, encoded=None):
+        self.data = data
+        self.keyframe = keyframe
+        self.seq = seq
+        self.encoded = time.time() if encoded is None else encoded
+        self.captured = self.encoded if captured is None else captured
+        # WebSocket frame header plus the flags byte the player reads
+        self.header = frame_header(1 + len(data)) + bytes((FLAG_KEYFRAME if keyframe else 0,))
+
+    def buffers(self):
+        """WebSocket message ready for sendmsg()"""
+        return [self.header, memoryview(self.data)]
+
+
+class VideoSlot:
+    """Frame queue of one client
+
+    Unlike JPEGs, H.264 frames can't be skipped one by one. A client that
+    falls `max_queue` frames behind loses its queue and picks up again at
+    the next keyframe.
+    """
+
+    def __init__(self, max_queue=60, on_resync=None):
+        self._frames = collections.deque()
+        self._ready = threading.Condition()
+        self.max_queue = max_queue
+        self.on_resync = on_resync
+        self.waiting_keyframe = True
+        self.sent = 0
+        self.dropped = 0
+        self.backlog = 0
+        self.lag = None
+
+    def put(self, frame):
+        with self._ready:
+            if self.waiting_keyframe and not frame.keyframe:
+                self.dropped += 1
+                return
+            self.waiting_keyframe = False
+            if len(self._frames) >= self.max_queue:
+                self.dropped += len(self._frames) + 1
+                self._frames.clear()
+                self.waiting_keyframe = True
+                if self.on_resync is not None:
+                    self.on_resync()
+                return
+            self._frames.append(frame)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Wait for the next frame, None on timeout"""
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._frames, timeout):
+                return None
+            self.sent += 1
+            return self._frames.popleft()
+
+
+class FrameBroadcaster(io.BufferedIOBase):
+    """Encoder output that hands every frame to all subscribed clients
+
+    Each frame is stored once and shared by reference. A client only
+    wakes on its own slot, so nobody waits on a lock held by the others.
+    """
+
+    def __init__(self):
+        self._clients = set()
+        self._lock = threading.Lock()
+        self.frame = None
+        self.seq = 0
+        self.metrics = StreamMetrics()
+
+    def write(self, buf, captured=None):
+        """
+        Hand a frame to every client
+
+        :param buf: JPEG
+        :type buf: bytes-like
+        :param captured: wall clock time the frame was captured, now if None
+        :type captured: float
+        """
+        data = buf if isinstance(buf, bytes) else bytes(buf)
+        self.seq += 1
+        frame = Frame(data, self.seq, captured)
+        self.metrics.frame(frame)
+        self.frame = frame
+        with self._lock:
+            clients = tuple(self._clients)
+        for slot in clients:
+            slot.put(frame)
+        return len(data)
+
+    def subscribe(self, slot=None):
+        """Register a slot, anything with put(frame), a new ClientSlot by default"""
+        if slot is None:
+            slot = ClientSlot()
+        with self._lock:
+            self._clients.add(slot)
+        return slot
+
+    def unsubscribe(self, slot):
+        with self._lock:
+            self._clients.discard(slot)
+
+    def clients(self):
+        """Every client slot, including those behind a fanout with a slots attribute
+
+        Fanouts replace their slots set instead of changing it, so it can be read from any thread.
+        """
+        with self._lock:
+            subscribers = tuple(self._clients)
+        slots = []
+        for sub in subscribers:
+            slots.extend(getattr(sub, 'slots', (sub,)))
+        return slots
+
+    def client_count(self):
+        return len(self.clients())
+
+
+class ClientLimit:
+    """Counts the HTTP and WebSocket clients being streamed to
+
+    Only viewers count, not subscribers such as the recorder or the frame
+    ring, so --max-clients means the same whatever else is enabled.
+    """
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a place for a new client, False if max_clients are already served"""
+        with self._lock:
+            if self.count >= self.max_clients:
+                return False
+            self.count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.count -= 1
+
+
+def send_buffers(sock, buffers):
+    """Send a list of buffers with as few sendmsg() calls as possible"""
+    buffers = [memoryview(b) for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # drop what went out, keep the rest of a partially sent buffer
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def unsent_bytes(sock):
+    """Bytes written to a TCP socket that the peer has not acknowledged yet"""
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+    except OSError:
+        return 0
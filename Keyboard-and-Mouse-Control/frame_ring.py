@@ -0,0 +1,204 @@
+"""
+Shared memory ring of camera frames for processes on the same Pi
+
+The camera server writes, any number of local processes read without
+HTTP or a second JPEG decode::
+
+    from frame_ring import FrameRingReader
+
+    ring = FrameRingReader()
+    print(ring.format)            # e.g. "YUV420 640x360 stride 640" or "jpeg 1280x720"
+    seq = 0
+    while True:
+        frame = ring.wait(seq)
+        seq = frame.seq
+        process(frame.data)       # memoryview into the ring, no copy
+        if not ring.valid(frame):
+            pass                  # the writer lapped us while we were reading, discard the result
+
+Layout: a 128 byte header (magic, slot count, slot size, last written
+sequence number, format string) followed by the slots, each a 24 byte
+header (sequence number, timestamp, length) and slot size bytes of data.
+A slot's sequence number is 0 while it is being written.
+"""
+import struct
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+NAME = 'camera_car_frames'
+MAGIC = b'CARRING1'
+
+HEADER = struct.Struct('<8sIIQ64s')
+HEADER_SIZE = 128
+HEAD_OFFSET = 16
+SLOT = struct.Struct('<QdI4x')
+
+RingFrame = namedtuple('RingFrame', 'seq timestamp data')
+"""A frame in the ring, data is a memoryview into shared memory"""
+
+
+class FrameRingWriter(object):
+    """Publishes frames into the ring, one writer per ring"""
+
+    def __init__(self, slot_size, slots=8, fmt='', name=NAME):
+        """
+        :param slot_size: largest frame in bytes, bigger frames are skipped
+        :type slot_size: int
+        :param slots: frames kept, readers more than this many frames behind lose frames
+        :type slots: int
+        :param fmt: what the frames are, shown to readers
+        :type fmt: str
+        :param name: shared memory name
+        :type name: str
+        """
+        self.slot_size = slot_size
+        self.slots = slots
+        self.skipped = 0
+        try:
+            # left behind by a writer that didn't close
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self._shm = shared_memory.SharedMemory(
+            name, create=True, size=HEADER_SIZE + slots * (SLOT.size + slot_size))
+        self._buf = self._shm.buf
+        HEADER.pack_into(self._buf, 0, MAGIC, slots, slot_size, 0, fmt.encode()[:64])
+        self.seq = 0
+
+    def write(self, data, timestamp=None):
+        """
+        Publish a frame
+
+        :param data: frame bytes
+        :type data: bytes-like
+        :param timestamp: capture time, time.time() if None
+        :type timestamp: float
+        :return: sequence number, None if the frame was too big
+        :rtype: int
+        """
+        data = memoryview(data).cast('B')
+        if len(data) > self.slot_size:
+            self.skipped += 1
+            return None
+        seq = self.seq + 1
+        offset = HEADER_SIZE + (seq % self.slots) * (SLOT.size + self.slot_size)
+        # readers seeing 0 know the slot is being rewritten
+        SLOT.pack_into(self._buf, offset, 0, 0.0, 0)
+        start = offset + SLOT.size
+        self._buf[start:start + len(data)] = data
+        SLOT.pack_into(self._buf, offset, seq, time.time() if timestamp is None else timestamp, len(data))
+        struct.pack_into('<Q', self._buf, HEAD_OFFSET, seq)
+        self.seq = seq
+        return seq
+
+    def close(self):
+        """Remove the ring, readers already attached keep their mapping"""
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class RingPublisher(object):
+    """FrameBroadcaster subscriber copying every JPEG into a ring
+
+    It counts as a client, so the encoder keeps running while it is subscribed.
+    """
+
+    def __init__(self, ring):
+        """
+        :param ring: ring to write to
+        :type ring: FrameRingWriter
+        """
+        self.ring = ring
+        self.sent = 0
+        self.dropped = 0
+        self.backlog = 0
+
+    def put(self, frame):
+        if self.ring.write(frame.data, frame.captured) is not None:
+            self.sent += 1
+
+
+class FrameRingReader(object):
+    """Reads frames from a ring another process writes"""
+
+    def __init__(self, name=NAME):
+        """
+        :param name: shared memory name
+        :type name: str
+        :raises FileNotFoundError: no writer has created the ring
+        """
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before Python 3.13 the tracker would unlink the writer's ring when this process exits
+            self._shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._buf = self._shm.buf
+        magic, self.slots, self.slot_size, _, fmt = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{name} is not a frame ring')
+        self.format = fmt.rstrip(b'\0').decode()
+
+    def head(self):
+        """Sequence number of the newest frame, 0 if none was written yet"""
+        return struct.unpack_from('<Q', self._buf, HEAD_OFFSET)[0]
+
+    def read(self, seq):
+        """
+        Get a frame by sequence number
+
+        :param seq: sequence number
+        :type seq: int
+        :return: frame, None if it was overwritten or not written yet
+        :rtype: RingFrame
+        """
+        offset = HEADER_SIZE + (seq % self.slots) * (SLOT.size + self.slot_size)
+        slot_seq, timestamp, length = SLOT.unpack_from(self._buf, offset)
+        if slot_seq != seq:
+            return None
+        start = offset + SLOT.size
+        frame = RingFrame(seq, timestamp, self._buf[start:start + length])
+        # the writer may have started on the slot between the two reads above
+        return frame if self.valid(frame) else None
+
+    def latest(self):
+        """Newest frame, None if there is none"""
+        seq = self.head()
+        return self.read(seq) if seq else None
+
+    def valid(self, frame):
+        """Check a frame's data wasn't overwritten, call after using it"""
+        offset = HEADER_SIZE + (frame.seq % self.slots) * (SLOT.size + self.slot_size)
+        return struct.unpack_from('<Q', self._buf, offset)[0] == frame.seq
+
+    def wait(self, after=0, timeout=None, poll=0.002):
+        """
+        Wait for a frame newer than `after`, skipping to the newest one
+
+        :param after: sequence number already seen
+        :type after: int
+        :param timeout: seconds, None waits forever
+        :type timeout: float
+        :param poll: seconds between checks
+        :type poll: float
+        :return: frame, None on timeout
+        :rtype: RingFrame
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.head() > after:
+                frame = self.latest()
+                if frame is not None:
+                    return frame
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+
+    def close(self):
+        """Detach, drop every frame read from the ring first"""
+        self._buf = None
+        self._shm.close()
@@ -0,0 +1,172 @@
+import fcntl
+import logging
+import struct
+import threading
+import time
+from picamera2.outputs import Output
+from frame_broadcast import VideoFrame, VideoSlot
+from stream_metrics import StreamMetrics, boot_to_wall
+
+VIDIOC_S_CTRL = 0xc008561c
+V4L2_CID_MPEG_VIDEO_FORCE_KEY_FRAME = 0x009909e5
+
+
+def make_encoder(bitrate, keyframe_interval, software=False):
+    """
+    H.264 encoder, the V4L2 hardware one if the Pi has it, libav otherwise
+
+    :param bitrate: bits per second
+    :type bitrate: int
+    :param keyframe_interval: frames between keyframes
+    :type keyframe_interval: int
+    :param software: skip the hardware encoder, e.g. for testing on a Pi 5
+    :type software: bool
+    """
+    if not software:
+        try:
+            from picamera2.encoders import H264Encoder
+            return H264Encoder(bitrate=bitrate, repeat=True, iperiod=keyframe_interval)
+        except Exception as e:
+            logging.warning('Hardware H.264 encoder unavailable, using libav: %s', str(e))
+    from picamera2.encoders import LibavH264Encoder
+    return LibavH264Encoder(bitrate=bitrate, repeat=True, iperiod=keyframe_interval)
+
+
+def capture_time(encoder, timestamp):
+    """
+    Wall clock time a frame was captured
+
+    :param encoder: encoder that produced the frame
+    :param timestamp: µs timestamp picamera2 passes to outputframe(),
+        relative to the encoder's first frame
+    :type timestamp: int
+    :rtype: float
+    """
+    if timestamp is None:
+        return time.time()
+    return boot_to_wall((getattr(encoder, 'firsttimestamp', None) or 0) + timestamp)
+
+
+class BroadcastOutput(Output):
+    """Encoder output handing JPEGs and their capture times to a FrameBroadcaster"""
+
+    def __init__(self, broadcaster, encoder):
+        super().__init__()
+        self.broadcaster = broadcaster
+        self.encoder = encoder
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        self.broadcaster.write(frame, capture_time(self.encoder, timestamp))
+
+
+def force_keyframe(encoder):
+    """Ask a V4L2 encoder for a keyframe now, False if it can't"""
+    vd = getattr(encoder, 'vd', None)
+    if vd is None:
+        return False
+    try:
+        fcntl.ioctl(vd, VIDIOC_S_CTRL, struct.pack('Ii', V4L2_CID_MPEG_VIDEO_FORCE_KEY_FRAME, 1))
+        return True
+    except (OSError, TypeError, ValueError):
+        return False
+
+
+class H264Stream(Output):
+    """Encoder output fanning H.264 out to WebSocket clients
+
+    The encoder only runs while someone is subscribed. A new client gets
+    a forced keyframe when the encoder supports it, otherwise the frames
+    since the last keyframe are replayed so it can start decoding at once.
+    """
+
+    def __init__(self, picam2, encoder, name='main', rate=None, fps=30, keyframe_gap=1.0):
+        """
+        :param picam2: camera the encoder runs on
+        :type picam2: Picamera2
+        :param encoder: from make_encoder()
+        :type encoder: H264Encoder
+        :param name: camera stream to encode, 'main' or 'lores'
+        :type name: str
+        :param rate: frame rate shared with the other streams of the camera
+        :type rate: CameraRate
+        :param fps: frame rate to ask for while running
+        :type fps: int
+        :param keyframe_gap: seconds between forced keyframes
+        :type keyframe_gap: float
+        """
+        super().__init__()
+        self.picam2 = picam2
+        self.encoder = encoder
+        self.name = name
+        self.rate = rate
+        self.fps = fps
+        self.keyframe_gap = keyframe_gap
+        self._gop = []
+        self._clients = set()
+        self._lock = threading.Lock()
+        # held while starting or stopping the encoder, never by outputframe()
+        self._encoder_lock = threading.Lock()
+        self._last_forced = 0
+        self.seq = 0
+        self.metrics = StreamMetrics()
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        self.seq += 1
+        video_frame = VideoFrame(bytes(frame), keyframe, self.seq, capture_time(self.encoder, timestamp))
+        self.metrics.frame(video_frame)
+        with self._lock:
+            if keyframe:
+                self._gop = [video_frame]
+            else:
+                self._gop.append(video_frame)
+            clients = tuple(self._clients)
+        for slot in clients:
+            slot.put(video_frame)
+
+    def request_keyframe(self):
+        """Force a keyframe, at most once per keyframe_gap, False if none was forced"""
+        now = time.monotonic()
+        if now - self._last_forced < self.keyframe_gap:
+            return False
+        if force_keyframe(self.encoder):
+            self._last_forced = now
+            return True
+        return False
+
+    def subscribe(self, slot=None):
+        if slot is None:
+            slot = VideoSlot(on_resync=self.request_keyframe)
+        with self._encoder_lock:
+            with self._lock:
+                first = not self._clients
+                self._clients.add(slot)
+                if not first and not self.request_keyframe():
+                    for video_frame in self._gop:
+                        slot.put(video_frame)
+            if first:
+                # starting the encoder begins with a keyframe
+                self.picam2.start_encoder(self.encoder, self, name=self.name)
+                if self.rate is not None:
+                    self.rate.request('h264', self.fps)
+        return slot
+
+    def unsubscribe(self, slot):
+        with self._encoder_lock:
+            with self._lock:
+                if slot not in self._clients:
+                    return
+                self._clients.discard(slot)
+                last = not self._clients
+                if last:
+                    self._gop = []
+            if last:
+                self.picam2.stop_encoder(self.encoder)
+                if self.rate is not None:
+                    self.rate.request('h264', None)
+
+    def clients(self):
+        with self._lock:
+            return list(self._clients)
+
+    def client_count(self):
+        return len(self.clients())
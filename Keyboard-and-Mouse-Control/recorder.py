@@ -0,0 +1,218 @@
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import numpy as np
+from picamera2 import MappedArray
+
+
+class Recorder(object):
+    """Records a JPEG stream to disk, including the seconds before the trigger
+
+    The last pre_roll seconds of frames are always kept in memory. A
+    trigger writes them out followed by live frames until post_roll
+    seconds after the last trigger. Files are written by one thread, the
+    encoder thread only queues frames and drops them if the writer falls
+    max_queue frames behind, so recording never stalls the live stream.
+
+    Each recording is an .mjpeg file of concatenated JPEGs plus an .idx
+    file with one "seq capture_time offset length" line per frame.
+    """
+
+    def __init__(self, output, directory='recordings', pre_roll=5.0, post_roll=10.0,
+                 max_queue=300, fsync_interval=1.0, fps=30):
+        """
+        :param output: stream to record
+        :type output: FrameBroadcaster
+        :param directory: where recordings go
+        :type directory: str
+        :param pre_roll: seconds kept from before the trigger
+        :type pre_roll: float
+        :param post_roll: seconds recorded after the last trigger
+        :type post_roll: float
+        :param max_queue: frames waiting for the writer before new ones are dropped
+        :type max_queue: int
+        :param fsync_interval: seconds between fsync() calls while recording
+        :type fsync_interval: float
+        :param fps: highest frame rate expected, bounds the pre-roll buffer
+        :type fps: int
+        """
+        self.output = output
+        self.directory = directory
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.max_queue = max_queue
+        self.fsync_interval = fsync_interval
+        self.recording = False
+        self.path = None
+        self._pre = collections.deque(maxlen=int(pre_roll * fps) + 1)
+        self._stop_at = None
+        self._pending = 0
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        # client stats, the recorder is a subscriber like any other
+        self.sent = 0
+        self.dropped = 0
+        self.backlog = 0
+        self.lag = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write_loop, daemon=True, name='recorder')
+        self._thread.start()
+        self.output.subscribe(self)
+
+    def stop(self):
+        self.output.unsubscribe(self)
+        with self._lock:
+            self._finish()
+        self._queue.put(None)
+        self._thread.join()
+
+    def put(self, frame):
+        with self._lock:
+            self._pre.append(frame)
+            while frame.captured - self._pre[0].captured > self.pre_roll:
+                self._pre.popleft()
+            if not self.recording:
+                return
+            if self._stop_at is not None and frame.captured >= self._stop_at:
+                self._finish()
+            else:
+                self._enqueue(frame)
+
+    def trigger(self, reason, duration=None):
+        """
+        Start recording, or keep recording longer
+
+        :param reason: goes into the file name, e.g. "motion"
+        :type reason: str
+        :param duration: seconds to record from now, None to record until stop_recording()
+        :type duration: float
+        """
+        with self._lock:
+            stop_at = None if duration is None else time.time() + duration
+            if self.recording:
+                if self._stop_at is not None:
+                    self._stop_at = None if stop_at is None else max(self._stop_at, stop_at)
+                return
+            self.path = os.path.join(self.directory, time.strftime('%Y%m%d-%H%M%S') + f'-{reason}.mjpeg')
+            self._queue.put(('open', self.path))
+            for frame in self._pre:
+                self._enqueue(frame)
+            self.recording = True
+            self._stop_at = stop_at
+            logging.info('Recording to %s', self.path)
+
+    def stop_recording(self):
+        with self._lock:
+            self._finish()
+
+    def status(self):
+        """/record content"""
+        with self._lock:
+            return json.dumps({'recording': self.recording, 'path': self.path,
+                               'dropped': self.dropped, 'queued': self._pending}).encode()
+
+    def _enqueue(self, frame):
+        if self._pending >= self.max_queue:
+            self.dropped += 1
+            return
+        self._pending += 1
+        self._queue.put(('frame', frame))
+
+    def _finish(self):
+        if self.recording:
+            self.recording = False
+            self._queue.put(('close',))
+            logging.info('Recording to %s finished', self.path)
+
+    def _write_loop(self):
+        data = index = None
+        offset = 0
+        synced = 0
+        while True:
+            item = self._queue.get()
+            if item is None or item[0] in ('open', 'close'):
+                if data is not None:
+                    for f in (data, index):
+                        f.flush()
+                        os.fsync(f.fileno())
+                        f.close()
+                    data = index = None
+                if item is None:
+                    return
+                if item[0] == 'open':
+                    os.makedirs(self.directory, exist_ok=True)
+                    data = open(item[1], 'wb')
+                    index = open(os.path.splitext(item[1])[0] + '.idx', 'w')
+                    offset = 0
+                continue
+
+            frame = item[1]
+            with self._lock:
+                self._pending -= 1
+            if data is None:
+                continue
+            data.write(frame.data)
+            index.write(f'{frame.seq} {frame.captured:.6f} {offset} {len(frame.data)}\n')
+            offset += len(frame.data)
+            self.sent += 1
+            self.lag = time.time() - frame.captured
+            # one fsync per interval rather than per frame
+            now = time.monotonic()
+            if now - synced >= self.fsync_interval:
+                for f in (data, index):
+                    f.flush()
+                    os.fsync(f.fileno())
+                synced = now
+
+
+class MotionDetector(object):
+    """Triggers a recorder when consecutive lores frames differ enough
+
+    Runs as a picamera2 post_callback. Only every `every`-th frame is
+    looked at, and only every `step`-th pixel of its luma, so the cost
+    is a few thousand subtractions per check.
+    """
+
+    def __init__(self, recorder, size, name='lores', threshold=8.0, step=8, every=5):
+        """
+        :param recorder: recorder to trigger
+        :type recorder: Recorder
+        :param size: width and height of the stream
+        :type size: tuple
+        :param name: camera stream to look at
+        :type name: str
+        :param threshold: mean absolute luma difference (0-255) that counts as motion
+        :type threshold: float
+        :param step: pixel spacing of the samples
+        :type step: int
+        :param every: frames between checks
+        :type every: int
+        """
+        self.recorder = recorder
+        self.width, self.height = size
+        self.name = name
+        self.threshold = threshold
+        self.step = step
+        self.every = every
+        self._count = 0
+        self._previous = None
+
+    def __call__(self, request):
+        self._count += 1
+        if self._count % self.every:
+            return
+        with MappedArray(request, self.name) as m:
+            # YUV420 arrays start with the luma plane, other formats use green
+            luma = m.array[:self.height:self.step, :self.width:self.step]
+            if luma.ndim == 3:
+                luma = luma[..., 1]
+            luma = luma.astype(np.int16)
+        previous, self._previous = self._previous, luma
+        if previous is not None and np.abs(luma - previous).mean() > self.threshold:
+            self.recorder.trigger('motion', self.recorder.post_roll)
@@ -0,0 +1,204 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+Level = namedtuple('Level', 'quality fps')
+
+LEVELS = (
+    Level(85, 30),
+    Level(70, 20),
+    Level(50, 15),
+    Level(35, 8),
+)
+"""Encoder settings from best to most economical"""
+
+
+class CameraRate:
+    """Sensor frame rate shared by every stream of one camera
+
+    Streams ask for a rate, the camera runs at the fastest rate any of
+    them asked for. A stream that stops asking no longer holds it up.
+    """
+
+    def __init__(self, picam2):
+        self.picam2 = picam2
+        self._wanted = {}
+        self._fps = None
+        self._lock = threading.Lock()
+
+    def request(self, name, fps):
+        """Ask for a frame rate, None withdraws the request"""
+        with self._lock:
+            if fps is None:
+                self._wanted.pop(name, None)
+            else:
+                self._wanted[name] = fps
+            if not self._wanted:
+                return
+            fps = max(self._wanted.values())
+            if fps != self._fps:
+                frame_us = int(1000000 / fps)
+                self.picam2.set_controls({'FrameDurationLimits': (frame_us, frame_us)})
+                self._fps = fps
+
+
+class StreamController:
+    """Adapts the shared JPEG encoder to how fast its clients keep up
+
+    Every interval each client is checked for frames it had to skip and
+    bytes stuck in its socket. If any client is congested the encoder
+    steps down one level, after `recover` clean intervals it steps back
+    up. A client slower than the encoder already skips frames in its own
+    slot, so the frame rate each client sees adapts per client; quality
+    and the encoder rate follow the most congested one. With no client
+    connected the encoder is stopped, it only starts once someone connects.
+    """
+
+    def __init__(self, picam2, encoder, encoder_output, output, name='main', rate=None, levels=LEVELS,
+                 interval=1.0, recover=5, drop_ratio=0.3, backlog_frames=2, idle_grace=2.0):
+        """
+        :param picam2: camera the encoder runs on
+        :type picam2: Picamera2
+        :param encoder: encoder to adapt, pause and resume
+        :type encoder: JpegEncoder
+        :param encoder_output: output the encoder writes to when running
+        :type encoder_output: BroadcastOutput
+        :param output: where clients subscribe
+        :type output: FrameBroadcaster
+        :param name: camera stream the encoder reads, 'main' or 'lores'
+        :type name: str
+        :param rate: frame rate shared with the other streams of the camera
+        :type rate: CameraRate
+        :param levels: settings to step through, best first
+        :type levels: tuple
+        :param interval: seconds between checks
+        :type interval: float
+        :param recover: clean intervals before stepping back up
+        :type recover: int
+        :param drop_ratio: share of frames a client may skip before it is congested
+        :type drop_ratio: float
+        :param backlog_frames: frames a client's socket may hold before it is congested
+        :type backlog_frames: int/float
+        :param idle_grace: seconds without clients before the encoder stops
+        :type idle_grace: float
+        """
+        self.picam2 = picam2
+        self.encoder = encoder
+        self.encoder_output = encoder_output
+        self.output = output
+        self.name = name
+        self.rate = rate if rate is not None else CameraRate(picam2)
+        self.levels = levels
+        self.interval = interval
+        self.recover = recover
+        self.drop_ratio = drop_ratio
+        self.backlog_frames = backlog_frames
+        self.idle_grace = idle_grace
+        self.level = None
+        self.paused = True
+        self._clean = 0
+        self._idle_since = None
+        self._seen = {}
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self.apply(0)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name='stream-control')
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        """Check now rather than at the next interval, e.g. when a client connects"""
+        self._wake.set()
+
+    def snapshot(self, timeout=3.0):
+        """
+        Latest frame, waits for the encoder to start if it is paused
+
+        :param timeout: seconds to wait for a frame
+        :type timeout: float
+        :return: frame, None on timeout
+        :rtype: Frame
+        """
+        if not self.paused and self.output.frame is not None:
+            return self.output.frame
+        # subscribing keeps the encoder running until the frame arrives
+        slot = self.output.subscribe()
+        try:
+            self.wake()
+            return slot.get(timeout)
+        finally:
+            self.output.unsubscribe(slot)
+
+    def apply(self, level):
+        """Switch the encoder to one of the levels"""
+        if level == self.level:
+            return
+        quality, fps = self.levels[level]
+        self.encoder.q = quality
+        if not self.paused:
+            self.rate.request(self.name, fps)
+        logging.info('Stream %s level %d: quality %d, %d fps', self.name, level, quality, fps)
+        self.level = level
+
+    def congested(self, slot):
+        """Check a client against its counters at the previous check"""
+        sent, dropped = slot.sent, slot.dropped
+        last_sent, last_dropped = self._seen.get(slot, (sent, dropped))
+        self._seen[slot] = (sent, dropped)
+        new_sent, new_dropped = sent - last_sent, dropped - last_dropped
+        if new_dropped > self.drop_ratio * max(1, new_sent + new_dropped):
+            return True
+        frame = self.output.frame
+        return frame is not None and slot.backlog > self.backlog_frames * len(frame.data)
+
+    def check(self, now):
+        clients = self.output.clients()
+        # forget clients that left
+        self._seen = {slot: self._seen[slot] for slot in clients if slot in self._seen}
+
+        if not clients:
+            if self._idle_since is None:
+                self._idle_since = now
+            if not self.paused and now - self._idle_since >= self.idle_grace:
+                self.picam2.stop_encoder(self.encoder)
+                self.paused = True
+                self.rate.request(self.name, None)
+                logging.info('No %s stream clients, encoder paused', self.name)
+            return
+        self._idle_since = None
+        if self.paused:
+            self.picam2.start_encoder(self.encoder, self.encoder_output, name=self.name)
+            self.paused = False
+            self.rate.request(self.name, self.levels[self.level].fps)
+            logging.info('%s stream client connected, encoder started', self.name)
+
+        # evaluate every client so each one's counters stay current
+        congested = [self.congested(slot) for slot in clients]
+        if any(congested):
+            self._clean = 0
+            self.apply(min(self.level + 1, len(self.levels) - 1))
+        else:
+            self._clean += 1
+            if self._clean >= self.recover and self.level > 0:
+                self._clean = 0
+                self.apply(self.level - 1)
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.check(time.monotonic())
+            except Exception as e:
+                logging.warning('Stream control failed: %s', str(e))
@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+
+FPS_BOUNDS = (5, 10, 15, 20, 25, 30, 60)
+MS_BOUNDS = (5, 10, 20, 40, 80, 160, 320, 640)
+
+
+def boot_to_wall(boot_us):
+    """Wall clock time of a CLOCK_BOOTTIME timestamp in µs, the clock libcamera stamps frames with"""
+    return time.time() - (time.clock_gettime(time.CLOCK_BOOTTIME) - boot_us / 1000000)
+
+
+class Histogram(object):
+    """Counts of values at or below each bound, plus one bucket above the last"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        buckets = {f'le_{bound}': count for bound, count in zip(self.bounds, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {'buckets': buckets, 'count': self.count,
+                'mean': self.sum / self.count if self.count else None}
+
+
+class StreamMetrics(object):
+    """Frame rate, encode time and send lag of one encoded stream"""
+
+    def __init__(self):
+        self.frames = 0
+        self.fps = Histogram(FPS_BOUNDS)
+        self.encode_ms = Histogram(MS_BOUNDS)
+        self.lag_ms = Histogram(MS_BOUNDS)
+        self._last_encoded = None
+        self._lock = threading.Lock()
+
+    def frame(self, frame):
+        """Record a frame as the encoder hands it over"""
+        with self._lock:
+            self.frames += 1
+            self.encode_ms.observe(1000 * (frame.encoded - frame.captured))
+            if self._last_encoded is not None and frame.encoded > self._last_encoded:
+                self.fps.observe(1 / (frame.encoded - self._last_encoded))
+            self._last_encoded = frame.encoded
+
+    def sent(self, slot, frame, backlog):
+        """
+        Record a frame written to a client
+
+        :param slot: the client's slot, gets its lag and backlog updated
+        :param frame: frame just written
+        :param backlog: bytes still queued for the client
+        :type backlog: int
+        """
+        lag = time.time() - frame.captured
+        slot.lag = lag
+        slot.backlog = backlog
+        with self._lock:
+            self.lag_ms.observe(1000 * lag)
+
+    def as_dict(self, clients):
+        with self._lock:
+            return {
+                'frames': self.frames,
+                'fps': self.fps.as_dict(),
+                'encode_ms': self.encode_ms.as_dict(),
+                'lag_ms': self.lag_ms.as_dict(),
+                'clients': [{
+                    'sent': slot.sent,
+                    'dropped': slot.dropped,
+                    'backlog': slot.backlog,
+                    'lag_ms': 1000 * slot.lag if getattr(slot, 'lag', None) is not None else None,
+                } for slot in clients],
+            }
+
+
+def report(streams, video=None):
+    """
+    /metrics content
+
+    :param streams: ?res= value to its StreamController
+    :type streams: dict
+    :param video: H.264 stream, if enabled
+    :type video: H264Stream
+    :return: JSON document
+    :rtype: bytes
+    """
+    doc = {}
+    for res, stream in streams.items():
+        doc[res] = stream.output.metrics.as_dict(stream.output.clients())
+        doc[res].update(level=stream.level, paused=stream.paused)
+    if video is not None:
+        doc['h264'] = video.metrics.as_dict(video.clients())
+    return json.dumps(doc).encode()
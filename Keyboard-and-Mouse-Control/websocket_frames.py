@@ -0,0 +1,28 @@
+import base64
+import hashlib
+import struct
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+
+
+def handshake_response(key):
+    """HTTP 101 accepting a WebSocket upgrade with the client's Sec-WebSocket-Key"""
+    accept = base64.b64encode(hashlib.sha1(key.strip().encode() + GUID).digest())
+    return (
+        b'HTTP/1.1 101 Switching Protocols\r\n'
+        b'Upgrade: websocket\r\n'
+        b'Connection: Upgrade\r\n'
+        b'Sec-WebSocket-Accept: ' + accept + b'\r\n'
+        b'\r\n')
+
+
+def frame_header(length, opcode=OP_BINARY):
+    """Header of a final, unmasked server to client frame carrying `length` bytes"""
+    if length < 126:
+        return struct.pack('!BB', 0x80 | opcode, length)
+    if length < 1 << 16:
+        return struct.pack('!BBH', 0x80 | opcode, 126, length)
+    return struct.pack('!BBQ', 0x80 | opcode, 127, length)
@@ -18,6 +18,8 @@ import io
 from scipy.io import wavfile
 import array
 from collections import deque
+import json
+import queue
 
 
 # -------------------------------------------------------------------- #
@@ -50,7 +52,9 @@ vad = webrtcvad.Vad(3) # 0 = very sensitive, 3 = less sensitive
 # -------------------------------------------------------------------- #
 
 WHISPER_SERVER = "http://local computer ip:8000/transcribe" # FastAPI whisper server
+WHISPER_STREAM_SERVER = "ws://local computer ip:8000/transcribe/stream" # same, fed while you speak
 PIPER_SERVER = "http://local computer ip:8000/speak" # FastAPI piper serverc
+PIPER_STREAM_SERVER = "http://local computer ip:8000/speak/stream" # same, played as each sentence arrives
 OLLAMA_SERVER = "http://local computer ip:11434/api/chat" # Ollama API on PC
 
 # -------------------------------------------------------------------- #
@@ -72,6 +76,7 @@ conversation_history = [{"role": "system", "content": "You are a helpful assista
 MAX_HISTORY = 20
 CHANNELS = 1
 tts_process = None
+tts_pending = None # reply requested but not playing yet, see TTSRequest
 stop_requested = False
 tts_lock = threading.Lock()
 current_far_audio = np.zeros(FRAME_SIZE, dtype=np.int16)
@@ -86,6 +91,7 @@ far_primed = False
 # -------------------------------------------------------------------- #
 ring_buffer = collections.deque(maxlen=BUFFER_SIZE)
 voiced_frames = []
+transcript_stream = None
 resampled_audio_buffer = []
 aec_buffer = []
 
@@ -166,12 +172,61 @@ def send_audio_to_server(filepath):
 	with open(filepath, "rb") as f:
 		files = {"file": ("clip.wav", f, "audio/wav")}
 		try:
-			response = requests.post(WHISPER_SERVER, files=files)
+			response = requests.post(WHISPER_SERVER, files=files, data={"mode": "command"}) # car commands take the fast path
 			return response.json()
 		except Exception as e:
 			print("Error sending to whisper server:", e)
 			return {"transcript": ""}
 
+# Stream speech to the whisper server while it is captured
+class TranscriptStream:
+	def __init__(self, url, sample_rate):
+		self.chunks = queue.Queue()
+		self.final = None
+		self.thread = threading.Thread(target=self._run, args=(url, sample_rate), daemon=True)
+		self.thread.start()
+		
+	def send(self, pcm_bytes):
+		self.chunks.put(pcm_bytes) # called from the audio callback, never blocks
+		
+	def finish(self, timeout=30):
+		# Final transcript, None if streaming failed
+		self.chunks.put(None)
+		self.thread.join(timeout)
+		return self.final
+		
+	def _run(self, url, sample_rate):
+		try:
+			ws = websocket.create_connection(url, timeout=30)
+			receiver = threading.Thread(target=self._receive, args=(ws,), daemon=True)
+			receiver.start()
+			ws.send(json.dumps({"sample_rate": sample_rate, "mode": "command"}))
+			while True:
+				chunk = self.chunks.get()
+				if chunk is None:
+					break
+				ws.send_binary(chunk)
+			ws.send(json.dumps({"type": "end"}))
+			receiver.join()
+			ws.close()
+		except Exception as e:
+			print("Error streaming to whisper server:", e)
+			
+	def _receive(self, ws):
+		try:
+			while True:
+				message = json.loads(ws.recv())
+				if message["type"] == "partial":
+					print("Partial:", message["text"])
+				elif message["type"] == "final":
+					self.final = message["text"]
+					return
+				else:
+					print("Whisper stream error:", message)
+					return
+		except Exception as e:
+			print("Error receiving from whisper server:", e)
+
 # Send transcript to Ollama server
 def get_ollama_response(prompt):
 	conversation_history.append({"role": "user", "content": prompt})
@@ -194,8 +249,110 @@ def get_ollama_response(prompt):
 		print("Error contacting Ollama:", e)
 		return ""
 		
-# Piper tts
+# A reply between speak_with_piper() and its player starting, so it can be gated and interrupted
+class TTSRequest:
+	def __init__(self):
+		self.cancelled = False
+		self.response = None
+		
+	def cancel(self):
+		# called with tts_lock held
+		self.cancelled = True
+		if self.response is not None:
+			self.response.close()
+			
+# Piper tts, streamed sentence by sentence, the whole WAV if streaming fails before any audio
 def speak_with_piper(text):
+	global tts_pending
+	request = TTSRequest()
+	with tts_lock:
+		tts_pending = request # set before returning, the caller may resume listening right away
+	threading.Thread(target=stream_from_piper, args=(text, request), daemon=True).start()
+	
+def stream_from_piper(text, request):
+	global tts_process, tts_pending, session_active
+	try:
+		opened = open_piper_stream(text, request)
+	finally:
+		with tts_lock:
+			if tts_pending is request:
+				tts_pending = None
+	if opened is None:
+		return
+	response, player, sample_rate = opened
+	leftover = b""
+	try:
+		# Playback starts with the first sentence while the rest is still being synthesized
+		for chunk in response.iter_content(chunk_size=4096):
+			if tts_process is not player:
+				break # interrupted
+			chunk = leftover + chunk
+			usable = len(chunk) - len(chunk) % 2
+			chunk, leftover = chunk[:usable], chunk[usable:]
+			if not chunk:
+				continue
+			pcm_data = np.frombuffer(chunk, dtype=np.int16)
+			if sample_rate != MIC_SAMPLE_RATE:
+				pcm_data = resample_audio(pcm_data, sample_rate, MIC_SAMPLE_RATE)
+			far_write(pcm_data) # AEC reference, in step with playback
+			player.stdin.write(chunk)
+			player.stdin.flush()
+		player.stdin.close()
+		player.wait()
+	except (OSError, ValueError):
+		pass # aplay killed by an interrupt
+	except Exception as e:
+		print("Error playing TTS stream:", e)
+	finally:
+		response.close()
+		with tts_lock:
+			if tts_process is player:
+				tts_process = None
+				
+	if session_active:
+		session_frames.append(np.zeros(TAIL_SAMPLES, dtype=np.int16))
+		full = np.concatenate(session_frames) if session_frames else np.zeros(1, np.int16)
+		save_audio(full, MIC_SAMPLE_RATE, "interaction_session.wav")
+		session_active = False
+		session_frames.clear()
+		
+def open_piper_stream(text, request):
+	# (response, player, sample rate) with the player set as tts_process, None if cancelled or played as WAV
+	global tts_process, stop_requested, far_primed
+	try:
+		response = requests.post(PIPER_STREAM_SERVER, data={"text": text}, stream=True, timeout=30)
+	except Exception as e:
+		if request.cancelled:
+			return None
+		print("Error using TTS stream:", e)
+		speak_with_piper_wav(text)
+		return None
+	with tts_lock:
+		if request.cancelled:
+			response.close()
+			return None
+		request.response = response
+	if response.status_code != 200:
+		print("TTS stream error:", response.text)
+		response.close()
+		speak_with_piper_wav(text)
+		return None
+		
+	sample_rate = int(response.headers.get("X-Sample-Rate", 22050))
+	stop_requested = False
+	far_primed = False # reset delay
+	player = subprocess.Popen(["aplay", "-q", "-t", "raw", "-f", "S16_LE", "-c", "1", "-r", str(sample_rate), "-"],
+		stdin=subprocess.PIPE)
+	with tts_lock:
+		if request.cancelled:
+			player.kill()
+			player.communicate()
+			response.close()
+			return None
+		tts_process = player
+	return response, player, sample_rate
+	
+def speak_with_piper_wav(text):
 	global tts_process, current_far_audio, far_primed
 	
 	current_far_audio = np.zeros(0, dtype=np.int16) # Global buffer
@@ -277,6 +434,8 @@ def parse_command(transcript):
 		return "right"
 	elif "stop" in words and "turn" in words:
 		return "stop turn"
+	elif "record" in words or "recording" in words:
+		return "stop recording" if "stop" in words else "record"
 	return None
 	
 # Send command to car for movement
@@ -299,6 +458,9 @@ def send_to_car(command):
 		elif command == "stop turn":
 			ws.send("left:0")
 			ws.send("right:0")
+		elif command in ("record", "stop recording"):
+			# the car passes these on to the camera server
+			ws.send("sent:" + command)
 	except Exception as e:
 		print("Failed to send to car:", e)
 
@@ -306,7 +468,7 @@ def send_to_car(command):
 # HANDLER FUNCTIONS                                                    #
 # -------------------------------------------------------------------- #
 def handle_voiced_frames():
-	global processing, voiced_frames, stop_requested
+	global processing, voiced_frames, stop_requested, transcript_stream
 	processing = True # Pause audio listening
 	
 	# Save Audio
@@ -323,8 +485,12 @@ def handle_voiced_frames():
 		wf.writeframes(b"".join(voiced_frames))
 		wf.close()
 		
-	transcript_data = send_audio_to_server(wf_name)
-	transcript = transcript_data.get("transcript", "").strip()
+	# Most of the transcription already happened while speaking
+	transcript = transcript_stream.finish() if transcript_stream is not None else None
+	transcript_stream = None
+	if transcript is None:
+		transcript_data = send_audio_to_server(wf_name)
+		transcript = transcript_data.get("transcript", "").strip()
 	print("Transcript:", transcript)
 	
 	command = parse_command(transcript)
@@ -359,8 +525,12 @@ def tts_watchdog():
 		time.sleep(0.05)
 		
 def interrupt_tts(reason=""):
-	global tts_process, stop_requested, far_primed
+	global tts_process, tts_pending, stop_requested, far_primed
 	with tts_lock:
+		if tts_pending is not None:
+			print(f"[TTS] Cancel pending reply: {reason}")
+			tts_pending.cancel()
+			tts_pending = None
 		if tts_process is not None:
 			print(f"[TTS] Interrupt: {reason}")
 			try:
@@ -381,7 +551,7 @@ def interrupt_tts(reason=""):
 # -------------------------------------------------------------------- #	
 # Continuous audio streaming
 def unified_audio_callback(indata, frames, time_info, status):
-	global wake_detected, processing, voiced_frames, session_active, stop_requested
+	global wake_detected, processing, voiced_frames, session_active, stop_requested, transcript_stream
 	
 	# -----------------------------------------------------------------#
 	# AEC PROCESSING                                        		   #
@@ -404,8 +574,8 @@ def unified_audio_callback(indata, frames, time_info, status):
 	# WAKE WORD DETECTION                                              #
 	# -----------------------------------------------------------------#
 	
-	# Only gate wake/VAD if in processing, no TTS gap
-	skip_wake_vad = (processing and tts_process is None)
+	# Only gate wake/VAD if in processing or waiting for the reply to play, no TTS gap
+	skip_wake_vad = ((processing or tts_pending is not None) and tts_process is None)
 	
 	# Resample to 16kHz for Porcupine
 	if not skip_wake_vad:
@@ -425,7 +595,7 @@ def unified_audio_callback(indata, frames, time_info, status):
 					session_active = True
 					session_frames.clear()
 					
-					if tts_process is not None:
+					if tts_process is not None or tts_pending is not None:
 						interrupt_tts("wake word")
 						speak_with_piper("Yes?")
 					else:
@@ -449,8 +619,12 @@ def unified_audio_callback(indata, frames, time_info, status):
 			print("Speech started")
 			voiced_frames.extend(f for f, _ in ring_buffer)
 			ring_buffer.clear()
+			transcript_stream = TranscriptStream(WHISPER_STREAM_SERVER, MIC_SAMPLE_RATE)
+			for f in voiced_frames:
+				transcript_stream.send(f)
 		elif voiced_frames:
 			voiced_frames.append(vad_frame_volume_reduced)
+			transcript_stream.send(vad_frame_volume_reduced)
 			if sum(1 for _, s in ring_buffer if not s) > 0.9 * BUFFER_SIZE:
 				print("Speech ended")
 				wake_detected = False
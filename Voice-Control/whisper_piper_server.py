@@ -1,10 +1,23 @@
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import JSONResponse, FileResponse
-from starlette.background import BackgroundTask
+from fastapi import FastAPI, File, UploadFile, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import whisper
 import tempfile
 import os
 import subprocess
+import asyncio
+import io
+import json
+import math
+import queue
+import re
+import time
+import wave
+import threading
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+import torch
+from scipy.signal import firwin, lfilter, resample_poly
 from pathlib import Path
 
 # Run "uvicorn whisper_piper_server:app --host 0.0.0.0 --port 8000" to start the server (make sure to be in the working directory)
@@ -26,7 +39,15 @@ app = FastAPI()
 #
 # -------------------------------------------------------------------------------------------------------------------- #
 
-model = whisper.load_model("large")  # Or "base", "small", etc.
+MODEL_TIERS = {"fast": "base", "accurate": "large"}  # Or "tiny", "small", etc.
+COMMAND_SECONDS = 3.0  # clips up to this long go to the fast model unless the client hints otherwise
+ESCALATE_LOGPROB = -0.8  # fast results less confident than this are redone by the accurate model
+COMMANDS = ["forward", "backward", "left", "right", "stop turn", "record", "stop recording"]  # mode=command vocabulary
+COMMAND_CONFIDENCE = 0.6  # below this the clip is transcribed freely instead
+
+SAMPLE_RATE = whisper.audio.SAMPLE_RATE  # 16 kHz, what whisper decodes
+PARTIAL_INTERVAL = 1.0  # seconds of new audio between partial transcripts
+STREAM_WINDOW = 20.0  # seconds decoded at most, older segments are settled and dropped
 
 # -------------------------------------------------------------------------------------------------------------------- #
 #
@@ -39,6 +60,8 @@ PIPER_MODEL = Path("piper") / "voices" / "en" / "en_GB-northern_english_male-med
 PIPER_CONFIG = Path(str(PIPER_MODEL) + ".json")
 OUTPUT_DIR = Path("tts_output")
 OUTPUT_DIR.mkdir(exist_ok=True)
+PIPER_PROCESSES = 2  # voices kept loaded, requests beyond this wait for a free one
+PIPER_TIMEOUT = 30.0  # seconds an utterance may take before its piper is restarted
 
 
 # -------------------------------------------------------------------------------------------------------------------- #
@@ -47,27 +70,404 @@ OUTPUT_DIR.mkdir(exist_ok=True)
 #
 # -------------------------------------------------------------------------------------------------------------------- #
 
+def resample(audio, sample_rate):
+    # float32 samples at sample_rate to the 16 kHz whisper decodes, low-pass filtered so content above 8 kHz
+    # doesn't alias into the speech band
+    if sample_rate == SAMPLE_RATE:
+        return audio
+    g = math.gcd(SAMPLE_RATE, sample_rate)
+    return resample_poly(audio, SAMPLE_RATE // g, sample_rate // g).astype(np.float32)
+
+
+class StreamResampler:
+    # resample() for audio arriving in small chunks. Filtering each chunk on its own would click at every chunk
+    # edge, so the low-pass filter state and the output sample position carry over from one chunk to the next.
+    def __init__(self, sample_rate):
+        self.step = sample_rate / SAMPLE_RATE
+        self.taps = None
+        if sample_rate > SAMPLE_RATE:
+            self.taps = firwin(101, 0.45 * SAMPLE_RATE, fs=sample_rate)
+            self.state = np.zeros(len(self.taps) - 1)
+        self.position = 0.0  # input index of the next output sample, from the start of the next chunk
+        self.last = 0.0  # last input sample of the previous chunk, at index -1
+
+    def process(self, audio):
+        if self.taps is not None:
+            audio, self.state = lfilter(self.taps, 1.0, audio, zi=self.state)
+        if len(audio) == 0:
+            return np.zeros(0, np.float32)
+        n = max(0, int(np.floor((len(audio) - 1 - self.position) / self.step)) + 1)
+        positions = self.position + np.arange(n) * self.step
+        out = np.interp(positions + 1, np.arange(len(audio) + 1), np.concatenate(([self.last], audio)))
+        self.position += n * self.step - len(audio)
+        self.last = audio[-1]
+        return out.astype(np.float32)
+
+
+def pcm_to_float(pcm):
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+
+
+def pcm_to_audio(pcm, sample_rate):
+    # int16 mono PCM to the float32 16 kHz samples whisper takes
+    return resample(pcm_to_float(pcm), sample_rate)
+
+
+def wav_to_audio(contents):
+    # Decode a PCM WAV in memory, None if it isn't one (compressed formats go through ffmpeg)
+    try:
+        with wave.open(io.BytesIO(contents)) as wav:
+            channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width == 1:
+        audio = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        audio = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+    elif width == 4:
+        audio = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2147483648
+    else:
+        return None
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1)
+    return resample(audio, rate)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class InferenceWorker:
+    # Runs every whisper decode on one thread, so the event loop never blocks on the model.
+    # Clips of at most 30 s without a prompt that are queued together go through the model as one batch.
+
+    def __init__(self, model, max_queue=32, max_batch=8, batch_wait=0.02):
+        self.model = model
+        self.jobs = queue.Queue(max_queue)
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait  # seconds to wait for more clips to batch with
+        self.clips = 0
+        self.batches = 0
+        self.wait_total = 0.0
+        self.decode_total = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True, name="whisper")
+        self.thread.start()
+
+    def submit(self, audio, prompt=None, commands=None):
+        # audio is a float32 16 kHz array or a file path for ffmpeg, prompt is text already transcribed before it,
+        # commands scores the audio against those phrases instead of transcribing it
+        future = Future()
+        try:
+            self.jobs.put_nowait((audio, prompt, future, time.monotonic(), commands))
+        except queue.Full:
+            raise QueueFull(f"{self.jobs.maxsize} transcriptions already queued")
+        return future
+
+    async def transcribe(self, audio, prompt=None):
+        return await asyncio.wrap_future(self.submit(audio, prompt))
+
+    async def match_command(self, audio, commands):
+        return await asyncio.wrap_future(self.submit(audio, commands=commands))
+
+    def stats(self):
+        return {
+            "queued": self.jobs.qsize(),
+            "clips": self.clips,
+            "batches": self.batches,
+            "wait_ms_avg": 1000 * self.wait_total / self.clips if self.clips else None,
+            "decode_ms_avg": 1000 * self.decode_total / self.batches if self.batches else None,
+        }
+
+    def _batchable(self, job):
+        audio, prompt, commands = job[0], job[1], job[4]
+        return (prompt is None and commands is None and isinstance(audio, np.ndarray)
+                and len(audio) <= whisper.audio.N_SAMPLES)
+
+    def _run(self):
+        while True:
+            batch = [self.jobs.get()]
+            leftover = None
+            if self._batchable(batch[0]):
+                deadline = time.monotonic() + self.batch_wait
+                while len(batch) < self.max_batch:
+                    try:
+                        job = self.jobs.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if not self._batchable(job):
+                        leftover = job
+                        break
+                    batch.append(job)
+            self._run_batch(batch)
+            if leftover is not None:
+                self._run_batch([leftover])
+
+    def _run_batch(self, batch):
+        started = time.monotonic()
+        batch = [job for job in batch if job[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            if len(batch) == 1:
+                audio, prompt, commands = batch[0][0], batch[0][1], batch[0][4]
+                if commands is not None:
+                    results = [self._score_commands(audio, commands)]
+                elif prompt is None:
+                    results = [self.model.transcribe(audio)]
+                else:
+                    results = [self.model.transcribe(audio, initial_prompt=prompt or None,
+                                                     condition_on_previous_text=False)]
+            else:
+                results = self._decode_batch([job[0] for job in batch])
+        except Exception as e:
+            for job in batch:
+                job[2].set_exception(e)
+        else:
+            for job, result in zip(batch, results):
+                job[2].set_result(result)
+        self.clips += len(batch)
+        self.batches += 1
+        self.wait_total += sum(started - job[3] for job in batch)
+        self.decode_total += time.monotonic() - started
+
+    def _decode_batch(self, clips):
+        # one padded 30 s window per clip, encoded and decoded together
+        mels = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(clip), n_mels=self.model.dims.n_mels)
+                            for clip in clips]).to(self.model.device)
+        options = whisper.DecodingOptions(fp16=self.model.device.type == "cuda", without_timestamps=True)
+        return [{"text": result.text, "avg_logprob": result.avg_logprob}
+                for result in whisper.decode(self.model, mels, options)]
+
+    def _score_commands(self, audio, commands):
+        # Teacher-force every command through the decoder in one batch on one encoder pass,
+        # far cheaper than decoding token by token. A command's score is its mean token log-probability,
+        # end of text included so longer speech doesn't match a command it starts with.
+        model = self.model
+        tokenizer = whisper.tokenizer.get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                                                    language="en", task="transcribe")
+        prefix = list(tokenizer.sot_sequence_including_notimestamps)
+        # whisper writes "Forward." as often as "forward", try the usual spellings
+        variants = [(command, f" {text}") for command in commands
+                    for text in (command.capitalize() + ".", command.capitalize(), command)]
+        sequences = [tokenizer.encode(text) + [tokenizer.eot] for _, text in variants]
+        width = max(len(sequence) for sequence in sequences)
+        tokens = torch.tensor([prefix + sequence + [tokenizer.eot] * (width - len(sequence)) for sequence in sequences],
+                              device=model.device)
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=model.dims.n_mels).to(model.device)
+        with torch.no_grad():
+            features = model.embed_audio(mel.unsqueeze(0))
+            logprobs = torch.log_softmax(model.logits(tokens, features.expand(len(sequences), -1, -1)).float(), dim=-1)
+
+        scores = {}
+        for i, ((command, _), sequence) in enumerate(zip(variants, sequences)):
+            # logits at position p predict the token at p + 1
+            positions = torch.arange(len(prefix) - 1, len(prefix) - 1 + len(sequence), device=model.device)
+            score = logprobs[i, positions, torch.tensor(sequence, device=model.device)].mean().item()
+            scores[command] = max(score, scores.get(command, -math.inf))
+        best = max(scores, key=scores.get)
+        return {"command": best, "confidence": math.exp(scores[best]), "scores": scores}
+
+
+def avg_logprob(result):
+    # confidence of a result, from the batch decode or averaged over transcribe()'s segments
+    if "avg_logprob" in result:
+        return result["avg_logprob"]
+    segments = result.get("segments") or []
+    return sum(segment["avg_logprob"] for segment in segments) / len(segments) if segments else 0.0
+
+
+class ModelPool:
+    # Keeps every model tier loaded and warm, each behind its own worker, and picks one per clip
+
+    def __init__(self, tiers):
+        self.workers = {}
+        for tier, name in tiers.items():
+            self.workers[tier] = InferenceWorker(whisper.load_model(name))
+            # the first decode pays for kernel setup, do it now rather than on the first request
+            self.workers[tier].submit(np.zeros(SAMPLE_RATE, np.float32))
+
+    def route(self, audio, hint=None):
+        if hint == "command":
+            return "fast"
+        if hint == "conversation":
+            return "accurate"
+        if isinstance(audio, np.ndarray) and len(audio) <= COMMAND_SECONDS * SAMPLE_RATE:
+            return "fast"
+        return "accurate"
+
+    async def transcribe(self, audio, prompt=None, hint=None, tier=None):
+        # hint is "command" or "conversation" from the client, tier skips routing and escalation
+        if tier is not None:
+            result = await self.workers[tier].transcribe(audio, prompt)
+            result["model"] = tier
+            return result
+        tier = self.route(audio, hint)
+        result = await self.workers[tier].transcribe(audio, prompt)
+        if tier == "fast" and avg_logprob(result) < ESCALATE_LOGPROB:
+            print(f"Escalating low confidence transcript: {result['text']!r}")
+            tier = "accurate"
+            result = await self.workers[tier].transcribe(audio, prompt)
+        result["model"] = tier
+        return result
+
+    async def match_command(self, audio, commands=COMMANDS):
+        # best command and its confidence, None if the clip is too long to be one
+        if not isinstance(audio, np.ndarray) or len(audio) > COMMAND_SECONDS * SAMPLE_RATE:
+            return None
+        return await self.workers["fast"].match_command(audio, commands)
+
+    def stats(self):
+        return {tier: worker.stats() for tier, worker in self.workers.items()}
+
+
+pool = ModelPool(MODEL_TIERS)
+
+
+def command_vocabulary(extra):
+    # COMMANDS plus a client's extra commands, comma separated, for both transcribe endpoints
+    extra = [command.strip() for command in (extra or "").split(",")]
+    return COMMANDS + [command for command in extra if command and command not in COMMANDS]
+
+
 @app.post("/transcribe")
-async def transcribe(file: UploadFile = File(...)):
+async def transcribe(file: UploadFile = File(...), sample_rate: int = Form(None), hint: str = Form(None),
+                     mode: str = Form(None), commands: str = Form(None)):
+    # mode=command first scores the clip against COMMANDS plus the comma separated commands field,
+    # and only transcribes it freely if no command is confident enough
     try:
-        # Create a temporary file but don't delete it automatically
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
+        contents = await file.read()
+        print(f"Uploaded audio size: {len(contents)} bytes")
+
+        # Raw int16 mono PCM when the sample rate is given, otherwise WAV, both decoded in memory
+        audio = pcm_to_audio(contents, sample_rate) if sample_rate else wav_to_audio(contents)
+        if audio is not None and mode == "command":
+            match = await pool.match_command(audio, command_vocabulary(commands))
+            if match is not None and match["confidence"] >= COMMAND_CONFIDENCE:
+                return JSONResponse(content={"transcript": match["command"], "command": match["command"],
+                                             "confidence": match["confidence"], "model": "fast"})
+        if audio is not None:
+            result = await pool.transcribe(audio, hint=hint)
+            return JSONResponse(content={"transcript": result["text"], "model": result["model"]})
+
+        # Anything else is left to ffmpeg, which needs a file
+        suffix = Path(file.filename or "").suffix or ".wav"
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
             temp_path = tmp.name
-            contents = await file.read()
             tmp.write(contents)
+        try:
+            result = await pool.transcribe(temp_path, hint=hint)
+        finally:
+            os.remove(temp_path)
+        return JSONResponse(content={"transcript": result["text"], "model": result["model"]})
 
-        # At this point, the file is closed and ffmpeg/whisper can access it
-        print(f"Uploaded audio size: {os.path.getsize(temp_path)} bytes")
-        result = model.transcribe(temp_path)
+    except QueueFull as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@app.get("/transcribe/stats")
+async def transcribe_stats():
+    return JSONResponse(content=pool.stats())
+
+
+# -------------------------------------------------------------------------------------------------------------------- #
+#
+# STREAMING TRANSCRIBE ENDPOINT
+#
+# -------------------------------------------------------------------------------------------------------------------- #
+
+# Protocol:
+#   client -> {"sample_rate": 48000, "hint": "command", "mode": "command", "commands": "honk,lights"}
+#                                       optional, before the audio, default 16000 and no hint,
+#                                       mode and commands as for /transcribe
+#   client -> binary int16 mono PCM     as it is captured, any chunk size
+#   client -> {"type": "end"}           end of speech
+#   server -> {"type": "partial", "text": ...}   about every PARTIAL_INTERVAL seconds of audio
+#   server -> {"type": "final", "text": ...}     after "end", then the server closes
+@app.websocket("/transcribe/stream")
+async def transcribe_stream(ws: WebSocket):
+    await ws.accept()
+    sample_rate = SAMPLE_RATE
+    hint = None
+    mode = None
+    commands = None
+    resampler = None
+    chunks = []
+    state = {"audio": np.zeros(0, np.float32), "committed": ""}
+    pending = None
+
+    def take_audio():
+        if chunks:
+            state["audio"] = np.concatenate([state["audio"]] + chunks)
+            chunks.clear()
+        return state["audio"]
+
+    async def partial(audio):
+        # partials only need to be quick
+        result = await pool.transcribe(audio, state["committed"], tier="fast")
+        segments = result["segments"]
+        text = result["text"]
+        # keep decoding cost bounded on long utterances: settle all but the last segment
+        if len(audio) > STREAM_WINDOW * SAMPLE_RATE and len(segments) > 1:
+            state["committed"] += "".join(segment["text"] for segment in segments[:-1])
+            state["audio"] = take_audio()[int(segments[-1]["start"] * SAMPLE_RATE):]
+            text = segments[-1]["text"]
+        await ws.send_json({"type": "partial", "text": (state["committed"] + text).strip()})
+
+    try:
+        decoded = 0
+        received = 0
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                if resampler is None:
+                    resampler = StreamResampler(sample_rate)
+                chunk = resampler.process(pcm_to_float(message["bytes"]))
+                chunks.append(chunk)
+                received += len(chunk)
+            elif message.get("text"):
+                control = json.loads(message["text"])
+                if control.get("type") == "end":
+                    break
+                sample_rate = control.get("sample_rate", sample_rate)
+                hint = control.get("hint", hint)
+                mode = control.get("mode", mode)
+                commands = control.get("commands", commands)
+                continue
+            # only one partial decode in flight, it always takes all audio so far
+            if (pending is None or pending.done()) and received - decoded >= PARTIAL_INTERVAL * SAMPLE_RATE:
+                decoded = received
+                pending = asyncio.create_task(partial(take_audio()))
 
-        # Clean up
-        os.remove(temp_path)
-        return JSONResponse(content={"transcript": result["text"]})
+        if pending is not None:
+            await pending
+        if mode == "command" and not state["committed"]:
+            match = await pool.match_command(take_audio(), command_vocabulary(commands))
+            if match is not None and match["confidence"] >= COMMAND_CONFIDENCE:
+                await ws.send_json({"type": "final", "text": match["command"], "command": match["command"],
+                                    "confidence": match["confidence"]})
+                await ws.close()
+                return
+        result = await pool.transcribe(take_audio(), state["committed"], hint=hint)
+        await ws.send_json({"type": "final", "text": (state["committed"] + result["text"]).strip()})
+        await ws.close()
 
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        await ws.send_json({"type": "error", "error": str(e)})
+        await ws.close()
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
 
 
 # -------------------------------------------------------------------------------------------------------------------- #
@@ -76,24 +476,156 @@ async def transcribe(file: UploadFile = File(...)):
 #
 # -------------------------------------------------------------------------------------------------------------------- #
 
+class PiperProcess:
+    # One piper kept running with its voice loaded. It reads a JSON line per utterance and, in --output_dir mode,
+    # prints the path of each finished WAV, which tells us where one utterance ends (raw output has no marker).
+    # The WAV is read back into memory and deleted straight away.
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.process = None
+        self.start()
+
+    def start(self):
+        command = [str(PIPER_BINARY), "--model", str(PIPER_MODEL), "--config", str(PIPER_CONFIG), "--json-input",
+                   "--output_dir", str(self.directory)]
+        self.errors = deque(maxlen=20)
+        self.paths = queue.Queue()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # stdout is read on a thread so waiting for a path can time out, select() doesn't take pipes on Windows
+        threading.Thread(target=self._read, args=(self.process.stdout, self.paths), daemon=True).start()
+        # piper logs every utterance, stderr has to be drained or it eventually blocks
+        threading.Thread(target=self._drain, args=(self.process.stderr, self.errors), daemon=True).start()
+
+    def restart(self):
+        self.process.kill()
+        self.process.wait()
+        self.start()
+
+    def _read(self, stream, paths):
+        for line in stream:
+            paths.put(line.decode("utf-8").strip())
+        paths.put(None)  # piper exited
+
+    def _drain(self, stream, errors):
+        for line in stream:
+            errors.append(line.decode(errors="replace").rstrip())
+
+    def synthesize(self, text):
+        # WAV bytes of text
+        if self.process.poll() is not None:
+            self.start()
+        try:
+            self.process.stdin.write((json.dumps({"text": text}) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+            path = self.paths.get(timeout=PIPER_TIMEOUT)
+        except OSError:
+            path = None
+        except queue.Empty:
+            self.restart()
+            raise TimeoutError(f"piper gave no audio in {PIPER_TIMEOUT} s, restarted it")
+        if not path:
+            errors = "\n".join(self.errors)
+            self.restart()
+            raise RuntimeError("piper exited: " + errors)
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+
+class PiperPool:
+    # PiperProcess instances handed out one request at a time. Requests wait for a free one on the event loop,
+    # so a request cancelled while waiting never takes a process or an executor thread.
+    def __init__(self, size):
+        self.idle = asyncio.Queue()
+        for i in range(size):
+            self.idle.put_nowait(PiperProcess(OUTPUT_DIR / f"piper{i}"))
+
+    async def speak(self, text):
+        piper = await self.idle.get()
+        job = asyncio.get_running_loop().run_in_executor(None, piper.synthesize, text)
+        try:
+            # piper can't be interrupted mid utterance, a cancelled request lets it finish before it is reused
+            return await asyncio.shield(job)
+        finally:
+            job.add_done_callback(lambda _: self.release(piper, job))
+
+    def release(self, piper, job):
+        if not job.cancelled():
+            job.exception()  # a cancelled request has nobody to raise it to
+        self.idle.put_nowait(piper)
+
+
+tts = PiperPool(PIPER_PROCESSES)
+
+
 @app.post("/speak")
 async def speak(text: str = Form(...)):
     try:
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
-            temp_path = tmp.name
+        # Return audio from memory
+        wav = await tts.speak(text)
+        return Response(content=wav, media_type="audio/wav",
+                        headers={"Content-Disposition": 'attachment; filename="piper_output.wav"'})
+
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
 
-        command = [str(PIPER_BINARY), "--model", str(PIPER_MODEL), "--config", str(PIPER_CONFIG), "--output_file",
-                   temp_path]
-        result = subprocess.run(command, input=text.encode("utf-8"), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        if result.returncode != 0:
-            os.remove(temp_path)
-            return JSONResponse(content={"error": result.stderr.decode()}, status_code=500)
+def split_sentences(text):
+    # sentences to synthesize one by one, the first is ready long before the whole reply would be
+    return [sentence for sentence in re.split(r"(?<=[.!?;:])\s+|\n+", text.strip()) if sentence.strip()]
+
+
+def wav_to_pcm(wav):
+    with wave.open(io.BytesIO(wav)) as w:
+        return w.getframerate(), w.readframes(w.getnframes())
+
 
-        # Return audio file
-        task = BackgroundTask(os.remove, temp_path)
-        return FileResponse(temp_path, media_type="audio/wav", filename="piper_output.wav",
-                            background=task)
+@app.post("/speak/stream")
+async def speak_stream(text: str = Form(...)):
+    # Raw int16 mono PCM, sentence by sentence as each is synthesized, rate in the X-Sample-Rate header.
+    # Up to PIPER_PROCESSES sentences are synthesized ahead of the one being sent.
+    remaining = iter(split_sentences(text))
+    ahead = deque()
 
+    def refill():
+        while len(ahead) < PIPER_PROCESSES:
+            sentence = next(remaining, None)
+            if sentence is None:
+                return
+            ahead.append(asyncio.ensure_future(tts.speak(sentence)))
+
+    def cancel():
+        while ahead:
+            ahead.popleft().cancel()
+
+    refill()
+    if not ahead:
+        return JSONResponse(content={"error": "nothing to say"}, status_code=400)
+    try:
+        # the first sentence comes back before the response starts so failures still get a status code
+        job = ahead.popleft()
+        refill()
+        sample_rate, first = wav_to_pcm(await job)
     except Exception as e:
+        cancel()
         return JSONResponse(content={"error": str(e)}, status_code=500)
+
+    async def chunks():
+        try:
+            yield first
+            while ahead:
+                job = ahead.popleft()
+                refill()
+                yield wav_to_pcm(await job)[1]
+        except Exception:
+            # too late for an error status, the client sees the audio end early
+            import traceback
+            traceback.print_exc()
+        finally:
+            cancel()
+
+    return StreamingResponse(chunks(), media_type="audio/L16",
+                             headers={"X-Sample-Rate": str(sample_rate), "X-Channels": "1"})